@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 本地基准测试: 起一个模拟好买/天天基金四个接口的本地服务器, 各加载函数写本地库,
+# 按 1k/10k/50k 只基金报告 记录数/秒、请求延迟 p50/p99 和内存峰值.
+#
+#   python bench.py --db-url 'mysql+mysqldb://root@127.0.0.1:3306/fintech_bench?charset=utf8mb4&binary_prefix=true'
+#
+# 每个 (加载函数, 规模) 在单独的子进程里运行, 内存峰值只算这一个加载函数; 模拟服务器在父进程里.
+# BulkWriter 用的是 MySQL 的 ON DUPLICATE KEY UPDATE, 本地库也要是 MySQL.
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import localtime, monotonic, sleep, strftime
+from urllib.parse import parse_qs, urlparse
+
+from logs import setup_logging
+
+# 录制的响应, bench/detail.json 和 bench/rate.json 为某只基金接口返回的 Datas
+payloaddir = os.path.join(sys.path[0], 'bench')
+
+LOADERS = ('howbuy', 'em_wap', 'detail', 'rate')
+TABLES = {'howbuy': 'fund', 'em_wap': 'fund', 'detail': 'fund_detail', 'rate': 'fund_rate'}
+
+HB_PATH = '/fund/fundranking/ajax.htm'
+WAP_PATH = '/data/FundSuggestList.js'
+DETAIL_PATH = '/FundMApi/FundDetailInformation.ashx'
+RATE_PATH = '/FundMApi/FundRateInfo.ashx'
+QUERY = '?FCODE={}&deviceid=Wap&plat=Wap&product=EFund&version=2.0.0'
+
+# 好买排行每页条数
+PAGE_SIZE = 200
+
+DB_URL = 'mysql+mysqldb://root@127.0.0.1:3306/fintech_bench?charset=utf8mb4&binary_prefix=true'
+
+# 没有录制的响应时使用的样例
+DETAIL_SAMPLE = {'FCODE': '000001', 'FEATURE': '010', 'CYCLE': '', 'WEBBACKCODE': '', 'SHORTNAME': '华夏成长混合',
+                 'FULLNAME': '华夏成长证券投资基金', 'FTYPE': '混合型', 'ESTABDATE': '2001-12-18', 'ENDNAV': '3811435400.29',
+                 'FEGMRQ': '2019-03-31', 'RLEVEL_SZ': '3', 'RISKLEVEL': '3', 'JJGS': '华夏基金', 'TGYH': '建设银行',
+                 'JJGSID': '80000222', 'JJJL': '王泽实', 'NETNAV': '3216145101.00', 'BENCH': '本基金暂不设业绩比较基准',
+                 'INDEXCODE': '', 'INDEXNAME': '', 'PRSVPERIOD': '', 'PRSVDATE': '', 'PRSVTYPE': '', 'BUYTIME': '',
+                 'MGREXP': '1.50%', 'TRUSTEXP': '0.25%', 'SALESEXP': ''}
+
+RATE_SAMPLE = {'SGZT': '开放申购', 'SHZT': '开放赎回', 'DTZT': '1', 'MINSG': '10', 'MINDT': '10', 'MAXSG': '',
+               'MINSSG': '10', 'MINSBSG': '10', 'SSBCFMDATA': 'T+1', 'RDMCFMDATA': 'T+1',
+               'MGREXP': '1.50%', 'TRUSTEXP': '0.25%', 'SALESEXP': '',
+               'sg': [{'money': '小于100万', 'rate': '1.50%'}, {'money': '大于等于100万，小于500万', 'rate': '1.20%'},
+                      {'money': '大于等于500万', 'rate': '每笔1000元'}],
+               'sh': [{'time': '小于7天', 'rate': '1.50%'}, {'time': '大于等于7天，小于1年', 'rate': '0.50%'},
+                      {'time': '大于等于1年，小于2年', 'rate': '0.25%'}, {'time': '大于等于2年', 'rate': '0.00%'}]}
+
+
+def load_payload(name, default):
+
+    path = os.path.join(payloaddir, name + '.json')
+
+    if not os.path.exists(path):
+        return default
+
+    with open(path, encoding='UTF-8') as f:
+        return json.load(f)
+
+
+def fund_name(i):
+    return '基准{}号混合{}'.format(i, 'AC'[i % 2])
+
+
+class Upstream(object):
+    """一个端口上模拟四个接口, 共 n 只基金.
+
+    每个请求延迟 latency 的 0.5~1.5 倍, 按 error_rate 返回错误: 一半是 503, 一半是 200 的 HTML 错误页
+    (FundSuggestList.js 是流式解析, 只注入 503).
+    """
+
+    def __init__(self, n, latency=0.0, error_rate=0.0):
+        self.n = n
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self.codes = ['{:06d}'.format(i) for i in range(1, n + 1)]
+        self.index = {code: i for i, code in enumerate(self.codes, 1)}
+
+        self.detail = load_payload('detail', DETAIL_SAMPLE)
+        self.rate = load_payload('rate', RATE_SAMPLE)
+
+        datas = ['{}|JZ{}|{}|混合型|JIZHUN{}'.format(code, i, fund_name(i), i) for code, i in self.index.items()]
+        self.wap = 'FundSuggestList({{"Datas":{},"ErrCode":0}});'.format(json.dumps(datas, ensure_ascii=False)).encode('UTF-8')
+
+        self.server = None
+
+    def respond(self, path, query, body):
+        """返回 (状态码, 响应体)"""
+
+        if path == WAP_PATH:
+            return 200, self.wap
+
+        if path == HB_PATH:
+            page = int(parse_qs(body)['page'][0])
+            rows = [{'jjdm': code, 'jjjc': fund_name(self.index[code])}
+                    for code in self.codes[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]]
+            return 200, json.dumps({'list': rows}, ensure_ascii=False).encode('UTF-8')
+
+        code = parse_qs(query).get('FCODE', [''])[0]
+
+        if path == DETAIL_PATH and code in self.index:
+            data = dict(self.detail, FCODE=code, SHORTNAME=fund_name(self.index[code]))
+        elif path == RATE_PATH and code in self.index:
+            data = self.rate
+        else:
+            return 404, b''
+
+        return 200, json.dumps({'Datas': data, 'ErrCode': 0}, ensure_ascii=False).encode('UTF-8')
+
+    def start(self):
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self, body):
+
+                url = urlparse(self.path)
+
+                if upstream.latency:
+                    sleep(upstream.latency * (0.5 + random.random()))
+
+                r = random.random()
+                if r < upstream.error_rate / 2:
+                    status, data = 503, b''
+                elif r < upstream.error_rate and url.path != WAP_PATH:
+                    status, data = 200, '<html><body>系统繁忙</body></html>'.encode('UTF-8')
+                else:
+                    status, data = upstream.respond(url.path, url.query, body)
+
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_request('')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.handle_request(self.rfile.read(length).decode('UTF-8'))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def reset(db_url):
+    """删掉基准库里的表, 各加载函数的 db_init 会重新建表"""
+
+    from sqlalchemy import create_engine
+
+    from models import Base
+
+    engine = create_engine(db_url)
+
+    Base.metadata.drop_all(engine)
+
+    engine.dispose()
+
+
+def run_one(loader, n, base, db_url, concurrency, rps):
+    """子进程里运行一个加载函数, 返回结果字典"""
+
+    import state
+
+    # 不读写正式运行的页数/断点/ETag
+    state.statedir = tempfile.mkdtemp(prefix='bench_state_')
+
+    from metrics import Histogram, metrics
+
+    if loader in ('howbuy', 'em_wap'):
+        import fund
+
+        fund.hb_url = base + HB_PATH
+        fund.em_wap_url = base + WAP_PATH
+        fund.db_init(None, None, None, None, True, db_url)
+
+        if loader == 'howbuy':
+            run = lambda: fund.do_howbuy(max(1, concurrency), rps)
+        else:
+            run = fund.do_eastmoney_wap
+
+    elif loader == 'detail':
+        import detail
+
+        detail.em_url = base + DETAIL_PATH + QUERY
+        detail.db_init(None, None, None, None, True, db_url)
+
+        run = lambda: detail.do_em_dt(False, concurrency, rps)
+
+    else:
+        import rate
+
+        rate.url = base + RATE_PATH + QUERY
+        rate.db_init(None, None, None, None, True, db_url)
+
+        run = lambda: rate.getRate(False, False, rps)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    metrics.clear()
+
+    s_time = monotonic()
+    run()
+    elapsed = monotonic() - s_time
+
+    # 合并所有 endpoint 的请求耗时
+    latency = Histogram()
+    for (name, labels), h in metrics.histograms.items():
+        if name == 'http_request_seconds':
+            latency.counts = [a + b for a, b in zip(latency.counts, h.counts)]
+            latency.count = latency.count + h.count
+            latency.sum = latency.sum + h.sum
+
+    records = sum(v for (name, labels), v in metrics.counters.items()
+                  if name == 'rows_total' and ('table', TABLES[loader]) in labels)
+
+    return {'loader': loader,
+            'scale': n,
+            'records': records,
+            'seconds': elapsed,
+            'records_per_second': records / elapsed if elapsed else 0,
+            'requests': latency.count,
+            'p50_ms': latency.quantile(0.5) * 1000,
+            'p99_ms': latency.quantile(0.99) * 1000,
+            # Linux 上 ru_maxrss 的单位是 KB
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url', default=os.environ.get('BENCH_DB_URL', DB_URL), help='本地基准库, 每个规模开始前会删表')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 50000], help='基金数')
+    parser.add_argument('--loaders', nargs='+', default=list(LOADERS), choices=LOADERS)
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟接口的平均延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟接口返回 503 或 HTML 错误页的比例')
+    parser.add_argument('--concurrency', type=int, default=8, help='好买排行的窗口和详情的并发数, 0 为详情逐个抓取, 好买排行的窗口按 1 算')
+    parser.add_argument('--rps', type=float, default=1000, help='每秒最多请求数')
+    parser.add_argument('--force', action='store_true', help='库名里没有 bench 也照样删表')
+    parser.add_argument('--child', nargs=3, metavar=('LOADER', 'SCALE', 'BASE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        loader, n, base = args.child
+        result = run_one(loader, int(n), base, args.db_url, args.concurrency, args.rps)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    setup_logging()
+
+    from sqlalchemy.engine.url import make_url
+
+    if 'bench' not in (make_url(args.db_url).database or '') and not args.force:
+        sys.exit('refuse to drop tables in {}, use a *bench* database or --force'.format(make_url(args.db_url).database))
+
+    results = []
+
+    for n in args.scales:
+
+        reset(args.db_url)
+
+        upstream = Upstream(n, args.latency, args.error_rate)
+        upstream.start()
+
+        try:
+            for loader in args.loaders:
+                cmd = [sys.executable, os.path.abspath(__file__), '--child', loader, str(n), upstream.base,
+                       '--db-url', args.db_url, '--concurrency', str(args.concurrency), '--rps', str(args.rps)]
+                out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(out.decode('UTF-8').strip().splitlines()[-1])
+                results.append(result)
+
+                logging.info('%(loader)s scale:%(scale)d records:%(records)d %(seconds).2fs %(records_per_second).0f/s '
+                             'p50:%(p50_ms).1fms p99:%(p99_ms).1fms rss:%(peak_rss_mb).0fMB', result)
+        finally:
+            upstream.stop()
+
+    print('{:<8}{:>8}{:>9}{:>9}{:>10}{:>9}{:>9}{:>9}'.format('loader', 'scale', 'records', 'seconds', 'rec/s', 'p50 ms', 'p99 ms', 'rss MB'))
+    for r in results:
+        print('{loader:<8}{scale:>8}{records:>9}{seconds:>9.2f}{records_per_second:>10.0f}{p50_ms:>9.1f}{p99_ms:>9.1f}{peak_rss_mb:>9.0f}'.format(**r))
+
+    from metrics import metricsdir
+
+    if not os.path.exists(metricsdir):
+        os.mkdir(metricsdir)
+
+    path = os.path.join(metricsdir, 'bench_{}.json'.format(strftime('%Y%m%d_%H%M%S', localtime())))
+    with open(path, 'w', encoding='UTF-8') as f:
+        json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=1)
+
+    logging.info('bench results written to %s', path)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import logging
+import os
+import sqlite3
+import sys
+from time import time
+
+from schema import loads
+
+cachedir = os.path.join(sys.path[0], 'cache')
+
+
+class ResponseCache(object):
+    """以 URL 为键的本地响应缓存, 存在 sqlite 里.
+
+    过期时间由调用方按接口传入; 总大小超过 max_bytes 时按最近访问时间淘汰到 90% 以下.
+    只能在创建它的线程里使用.
+    """
+
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024):
+
+        if path is None:
+            if not os.path.exists(cachedir):
+                os.mkdir(cachedir)
+            path = os.path.join(cachedir, 'response.db')
+
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS response ('
+                          'url TEXT PRIMARY KEY, body BLOB, size INTEGER, stored REAL, accessed REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)')
+
+        self.max_bytes = max_bytes
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, url, ttl):
+        """返回 ttl 秒内缓存的响应体, 没有或已过期时返回 None"""
+
+        row = self.conn.execute('SELECT body, stored FROM response WHERE url=?', (url,)).fetchone()
+
+        now = time()
+
+        if row is None or now - row[1] > ttl:
+            self.misses = self.misses + 1
+            return None
+
+        self.conn.execute('UPDATE response SET accessed=? WHERE url=?', (now, url))
+        self.hits = self.hits + 1
+
+        return row[0]
+
+    def get_json(self, url, ttl):
+        body = self.get(url, ttl)
+        return None if body is None else loads(body)
+
+    def put(self, url, body):
+
+        now = time()
+
+        old = self.conn.execute('SELECT size FROM response WHERE url=?', (url,)).fetchone()
+        if old is not None:
+            self.size = self.size - old[0]
+
+        self.conn.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)', (url, body, len(body), now, now))
+        self.size = self.size + len(body)
+
+        if self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target):
+
+        rows = self.conn.execute('SELECT url, size FROM response ORDER BY accessed').fetchall()
+
+        urls = []
+        for url, size in rows:
+            if self.size <= target:
+                break
+            urls.append((url,))
+            self.size = self.size - size
+
+        self.conn.executemany('DELETE FROM response WHERE url=?', urls)
+        self.evictions = self.evictions + len(urls)
+
+    def report(self):
+        logging.info('cache hits:%d misses:%d evictions:%d size:%d', self.hits, self.misses, self.evictions, self.size)
+
+    def close(self):
+        self.conn.close()
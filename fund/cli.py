@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 统一入口: python cli.py {fund,detail,rate,all,queue,service} [参数...], 子命令后面的参数原样交给对应脚本.
+# 这里只导入标准库, 加载函数所在的模块在选定子命令之后才导入; 导入耗时记为 import_seconds,
+# 和本次运行的其他指标写在一起. 细看导入开销: python -X importtime cli.py fund --help
+
+import argparse
+import importlib
+from time import monotonic
+
+COMMANDS = {
+    'fund': ('fund', '好买和天天基金的基金列表'),
+    'detail': ('detail', '基金详情'),
+    'rate': ('rate', '基金费率'),
+    'all': ('pipeline', '一个进程里依次流过 fund -> detail -> rate'),
+    'queue': ('workqueue', '分片入队, 多个 worker 领取分片抓取详情或费率'),
+    'service': ('service', '按代码查询基金的缓存服务'),
+}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='\n'.join('{:8}{}'.format(k, v[1]) for k, v in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS.keys())
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='交给子命令的参数, 子命令 --help 查看')
+    args = parser.parse_args(argv)
+
+    s_time = monotonic()
+    module = importlib.import_module(COMMANDS[args.command][0])
+
+    from metrics import metrics
+    metrics.set('import_seconds', monotonic() - s_time, job=COMMANDS[args.command][0])
+
+    module.main(args.args)
+
+
+if __name__ == "__main__":
+    main()
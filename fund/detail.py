@@ -5,113 +5,62 @@ __author__ = 'lidc'
 
 # PYTHONUNBUFFERED=1
 
+import argparse
 import gc
 import getpass
-import json
 import logging
 import os
-import re
-import sys
-from pprint import pprint
-from random import randint, random
-from time import localtime, monotonic, sleep, strftime, time
-# from collections import OrderedDict
-from urllib.parse import quote_plus, urlencode
-
-# import demjson
-import MySQLdb
+from time import monotonic
+from urllib.parse import quote_plus
+
 import requests
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, create_engine, desc, func, text
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from fund import Fund
-
-s_time = monotonic()
-today = strftime('%Y%m%d', localtime())
-
-logdir = os.path.join(sys.path[0], 'log')
-
-if not os.path.exists(logdir):
-    os.mkdir(logdir)
-
-FORMAT = '[%(asctime)s %(levelname)s]<%(process)d> %(message)s'
-logfile = os.path.join(logdir, '{}_{}.log'.format(os.path.basename(__file__)[:-3], today))
-
-fh = logging.FileHandler(filename=logfile, encoding='UTF-8')
-logging.basicConfig(handlers=[logging.StreamHandler(), fh], format=FORMAT, level=logging.INFO)
-
-
-Base = declarative_base()
-
-
-class Fund_Detail(Base):
-
-    __tablename__ = 'fund_detail'
-
-    fcode = Column(String(8), primary_key=True, comment='基金代码')
-    feature = Column(String(32), comment='')
-    cycle = Column(String(4), comment='')
-    webbackcode = Column(String(8), comment='基金代码(后端)')
-    shortname = Column(String(32), comment='基金简称')
-    fullname = Column(String(64), comment='基金全称')
-    ftype = Column(String(8), comment='基金类型')
-    estabdate = Column(String(16), comment='成立日期')
-    endnav = Column(String(16), comment='资产规模')
-    fegmrq = Column(String(16), comment='规模截止日期')
-    rlevel_sz = Column(String(4), comment='基金评级')
-    risklevel = Column(String(4), comment='风险等级')
-    jjgs = Column(String(16), comment='基金管理人')
-    tgyh = Column(String(8), comment='基金托管人')
-    jjgsid = Column(String(8), comment='基金管理人代码')
-    jjjl = Column(String(32), comment='基金经理人')
-    netnav = Column(String(16), comment='成立规模')
-    bench = Column(String(160), comment='业绩比较基准')
-    indexcode = Column(String(16), comment='跟踪标的代码')
-    indexname = Column(String(64), comment='跟踪标的')
-    prsvperiod = Column(String(4), comment='')
-    prsvdate = Column(String(32), comment='')
-    prsvtype = Column(String(4), comment='')
-    buytime = Column(String(8), comment='')
-    mgrexp = Column(String(8), comment='管理费率')
-    trustexp = Column(String(8), comment='托管费率')
-    salesexp = Column(String(8), comment='销售服务费率')
-
-    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
-
-    # def __eq__(self,other):
-    #     return self.__dict__ == other.__dict__
-
-
-def __fund_detail(fund_detail, data):
-
-    fund_detail.fcode = data['FCODE']
-    fund_detail.feature = data['FEATURE']
-    fund_detail.cycle = data['CYCLE']
-    fund_detail.webbackcode = data['WEBBACKCODE']
-    fund_detail.shortname = data['SHORTNAME']
-    fund_detail.fullname = data['FULLNAME']
-    fund_detail.ftype = data['FTYPE']
-    fund_detail.estabdate = data['ESTABDATE']
-    fund_detail.endnav = data['ENDNAV']
-    fund_detail.fegmrq = data['FEGMRQ']
-    fund_detail.rlevel_sz = data['RLEVEL_SZ']
-    fund_detail.risklevel = data['RISKLEVEL']
-    fund_detail.jjgs = data['JJGS']
-    fund_detail.tgyh = data['TGYH']
-    fund_detail.jjgsid = data['JJGSID']
-    fund_detail.jjjl = data['JJJL']
-    fund_detail.netnav = data['NETNAV']
-    fund_detail.bench = data['BENCH']
-    fund_detail.indexcode = data['INDEXCODE']
-    fund_detail.indexname = data['INDEXNAME']
-    fund_detail.prsvperiod = data['PRSVPERIOD']
-    fund_detail.prsvdate = data['PRSVDATE']
-    fund_detail.prsvtype = data['PRSVTYPE']
-    fund_detail.buytime = data['BUYTIME']
-    fund_detail.mgrexp = data['MGREXP']
-    fund_detail.trustexp = data['TRUSTEXP']
-    fund_detail.salesexp = data['SALESEXP']
+import upsert
+from cache import ResponseCache
+from digest import DigestTracker
+from logs import setup_logging
+from metrics import write_metrics
+from migrate import add_missing_columns
+from models import Base, Fund, Fund_Detail, Fund_Digest
+from net import CircuitOpen, client, configure, fetch_all, report, send_json
+from schema import Field, Schema
+from snapshot import load_index
+from state import Checkpoint
+from upsert import BulkWriter
+
+
+# 详情接口 Datas 的字段, 顺序与 Fund_Detail 的列一致
+DETAIL = Schema('detail', [
+    Field('fcode', 'FCODE'),
+    Field('feature', 'FEATURE'),
+    Field('cycle', 'CYCLE'),
+    Field('webbackcode', 'WEBBACKCODE'),
+    Field('shortname', 'SHORTNAME'),
+    Field('fullname', 'FULLNAME'),
+    Field('ftype', 'FTYPE'),
+    Field('estabdate', 'ESTABDATE'),
+    Field('endnav', 'ENDNAV'),
+    Field('fegmrq', 'FEGMRQ'),
+    Field('rlevel_sz', 'RLEVEL_SZ'),
+    Field('risklevel', 'RISKLEVEL'),
+    Field('jjgs', 'JJGS'),
+    Field('tgyh', 'TGYH'),
+    Field('jjgsid', 'JJGSID'),
+    Field('jjjl', 'JJJL'),
+    Field('netnav', 'NETNAV'),
+    Field('bench', 'BENCH'),
+    Field('indexcode', 'INDEXCODE'),
+    Field('indexname', 'INDEXNAME'),
+    Field('prsvperiod', 'PRSVPERIOD'),
+    Field('prsvdate', 'PRSVDATE'),
+    Field('prsvtype', 'PRSVTYPE'),
+    Field('buytime', 'BUYTIME'),
+    Field('mgrexp', 'MGREXP'),
+    Field('trustexp', 'TRUSTEXP'),
+    Field('salesexp', 'SALESEXP'),
+])
 
 
 db_session = ''
@@ -119,11 +68,13 @@ db_funds = {}
 db_fund_detail = {}
 
 
-def db_init(db_user, db_passwd, db_host, db_name):
+def db_init(db_user, db_passwd, db_host, db_name, lean=False, db_url=None):
     # engine = create_engine("mysql+mysqldb://{}:{}@{}:3306/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
-    engine = create_engine("mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
+    # db_url 不为空时直接使用, 例如 bench 用的本地库
+    engine = create_engine(db_url or "mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
 
     Base.metadata.create_all(engine)
+    add_missing_columns(engine, Fund_Digest)
     # engine.execute('TRUNCATE TABLE fund_detail')
 
     Session = sessionmaker(bind=engine)
@@ -131,90 +82,239 @@ def db_init(db_user, db_passwd, db_host, db_name):
     global db_session
     db_session = Session()
 
-    funds = db_session.query(Fund.code, Fund).all()
-    fund_detail = db_session.query(Fund_Detail.fcode, Fund_Detail).all()
-
     global db_funds, db_fund_detail
 
-    db_funds = dict(funds)
-    db_fund_detail = dict(fund_detail)
+    if lean:
+        # 只载入主键和 update_time, 写库和抓取只用来判断某只基金是否已有
+        db_funds = load_index(db_session, Fund.code, Fund.update_time)
+        db_fund_detail = load_index(db_session, Fund_Detail.fcode, Fund_Detail.update_time)
+    else:
+        funds = db_session.query(Fund.code, Fund).all()
+        fund_detail = db_session.query(Fund_Detail.fcode, Fund_Detail).all()
+
+        # 写库统一走 BulkWriter, 载入的对象只作为内存快照
+        db_session.expunge_all()
+
+        db_funds = dict(funds)
+        db_fund_detail = dict(fund_detail)
 
     logging.info('fund count:%d    fund_detail count:%d',len(db_funds), len(db_fund_detail))
 
 
 em_url = 'https://fundmobapi.eastmoney.com/FundMApi/FundDetailInformation.ashx?FCODE={}&deviceid=Wap&plat=Wap&product=EFund&version=2.0.0'
-headers = {'Content-Type': 'application/json; charset=utf-8',
-           'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'}
+# 可选的本地响应缓存, 由 --cache 开启
+cache = None
+cache_ttl = 24 * 3600
+
 
-s = requests.Session()
-s.headers.update(headers)
+def do_em_dt(update, concurrency=0, rps=10, resume=False, refresh=()):
+    """refresh 为需要重新抓取的已有基金, 由 schedule.plan 按陈旧程度挑选"""
 
+    checkpoint = Checkpoint('detail', sorted(db_funds.keys()), update, refresh)
 
-def do_em_dt(update):
+    if resume:
+        update = checkpoint.resume()
+        refresh = checkpoint.refresh
 
-    items = []
+    if concurrency:
+        return do_em_dt_async(update, concurrency, rps, checkpoint, refresh)
+
+    from history import History
+
+    configure(em_url, 1, rps)
+
+    writer = BulkWriter(db_session, Fund_Detail, db_fund_detail, history=History(db_session, 'detail'))
+    tracker = DigestTracker(db_session, 'detail')
+    decoder = DETAIL.compile()
     i = 0
 
-    for code in db_funds.keys():
+    for code in checkpoint.remaining():
 
         i = i + 1
 
         req = requests.Request('GET', em_url.format(code))
-        prepped = s.prepare_request(req)
+        prepped = client().prepare_request(req)
 
-        if code not in db_fund_detail.keys():
+        if code not in db_fund_detail.keys() or update or code in refresh:
 
-            r = s.send(prepped)
-            j = r.json()
+            j, _ = send_json(client(), prepped, cache, cache_ttl)
 
-            data = j['Datas']
+            data = j.get('Datas') if j else None
 
-            if data:
+            if data and tracker.check(code, data, code in db_fund_detail.keys()):
 
-                fund_detail = Fund_Detail()
+                writer.add(decoder.row(data))
 
-                __fund_detail(fund_detail, data)
+        checkpoint.done(code)
 
-                items.append(fund_detail)
+        if i == 1000:
+            writer.flush()
+            tracker.flush()
+            checkpoint.commit()
 
-            sleep(random())
+            i = 0
+
+            gc.collect()
+
+            logging.info('detail commit 1k')
+
+    writer.flush()
+    tracker.flush()
+    tracker.report()
+    decoder.report()
+    checkpoint.clear()
+
+    logging.info('detail upsert over! inserted:%d updated:%d unchanged:%d',
+                 writer.inserted, writer.updated, writer.unchanged)
 
-        else:
 
-            if update:
+def do_em_dt_async(update, concurrency, rps, checkpoint, refresh=()):
 
-                r = s.send(prepped)
-                j = r.json()
+    from history import History
 
-                data = j['Datas']
+    writer = BulkWriter(db_session, Fund_Detail, db_fund_detail, history=History(db_session, 'detail'))
+    tracker = DigestTracker(db_session, 'detail')
+    decoder = DETAIL.compile()
+    i = 0
+
+    def jobs():
+        for code in checkpoint.remaining():
+            if code not in db_fund_detail.keys() or update or code in refresh:
+                yield code, em_url.format(code)
+            else:
+                checkpoint.done(code)
+
+    def handle(code, j):
 
-                if data:
+        nonlocal i
+
+        i = i + 1
 
-                    fund_detail = db_fund_detail[data['FCODE']]
+        data = j.get('Datas') if j else None
 
-                    __fund_detail(fund_detail, data)
+        if data and tracker.check(code, data, code in db_fund_detail.keys()):
 
-                sleep(random())
+            writer.add(decoder.row(data))
+
+        checkpoint.done(code)
 
         if i == 1000:
-            db_session.add_all(items)
-            db_session.commit()
-            # db_session.rollback()
+            writer.flush()
+            tracker.flush()
+            checkpoint.commit()
 
-            items.clear()
             i = 0
 
             gc.collect()
 
             logging.info('detail commit 1k')
 
-    db_session.add_all(items)
-    db_session.commit()
+    fetch_all(client(), jobs(), handle, concurrency, rps, cache, cache_ttl)
 
-    logging.info('detail upsert over!')
+    writer.flush()
+    tracker.flush()
+    tracker.report()
+    decoder.report()
+    checkpoint.clear()
 
+    logging.info('detail upsert over! inserted:%d updated:%d unchanged:%d',
+                 writer.inserted, writer.updated, writer.unchanged)
 
-if __name__ == "__main__":
+
+def do_em_dt_stream(batches, emit, concurrency=0, rps=10, refresh=(), tracker=None, history=None):
+    """pipeline 用: batches 陆续给出一批批基金代码, 抓取库里还没有详情的和 refresh 中的;
+    取到详情的代码交给 emit, 由费率阶段接着处理. 不记录断点, 中断后重跑即可.
+    tracker/history 为空时新建; 多次调用(例如 workqueue 每个分片一次)时由调用方传入, 免得每次重读索引"""
+
+    if history is None:
+        from history import History
+        history = History(db_session, 'detail')
+
+    configure(em_url, concurrency or 1, rps)
+
+    writer = BulkWriter(db_session, Fund_Detail, db_fund_detail, history=history)
+    tracker = tracker or DigestTracker(db_session, 'detail')
+    decoder = DETAIL.compile()
+    seen = set()
+    i = 0
+
+    def handle(code, j):
+
+        nonlocal i
+
+        i = i + 1
+
+        data = j.get('Datas') if j else None
+
+        if data:
+            if tracker.check(code, data, code in db_fund_detail.keys()):
+
+                writer.add(decoder.row(data))
+
+            emit(code)
+
+        if i == 1000:
+            writer.flush()
+            tracker.flush()
+
+            i = 0
+
+            gc.collect()
+
+            logging.info('detail commit 1k')
+
+    for batch in batches:
+
+        codes = [code for code in batch
+                 if code not in seen and (code not in db_fund_detail.keys() or code in refresh)]
+        seen.update(batch)
+
+        if concurrency:
+            fetch_all(client(), ((code, em_url.format(code)) for code in codes), handle, concurrency, rps, cache, cache_ttl)
+        else:
+            for code in codes:
+                prepped = client().prepare_request(requests.Request('GET', em_url.format(code)))
+                j, _ = send_json(client(), prepped, cache, cache_ttl)
+                handle(code, j)
+
+    writer.flush()
+    tracker.flush()
+    tracker.report()
+    decoder.report()
+
+    logging.info('detail upsert over! inserted:%d updated:%d unchanged:%d',
+                 writer.inserted, writer.updated, writer.unchanged)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--update', action='store_true', help='重新抓取已有的基金详情')
+    parser.add_argument('--budget', type=int, default=0, help='不加 --update 时, 按陈旧程度和变化频率挑选最多这么多只已有基金重新抓取')
+    parser.add_argument('--concurrency', type=int, default=0, help='同时在途的请求数, 0 为逐个抓取')
+    parser.add_argument('--rps', type=float, default=10, help='每秒最多请求数, 实际速率在此之内自适应调整')
+    parser.add_argument('--chunk-size', type=int, default=upsert.CHUNK_SIZE, help='每条 INSERT 语句的行数')
+    parser.add_argument('--cache', action='store_true', help='使用本地响应缓存, 详情缓存 24 小时')
+    parser.add_argument('--resume', action='store_true', help='从上次中断的位置继续, 沿用上次的 --update')
+    parser.add_argument('--lean', action='store_true', help='只载入主键索引, 不把整张表的对象放在内存里')
+    parser.add_argument('--export', action='store_true', help='抓取结束后导出列式快照')
+    args = parser.parse_args(argv)
+
+    from schedule import plan
+    from search import refresh_index
+    from service import notify_on_commit
+
+    setup_logging('detail')
+    notify_on_commit()
+
+    s_time = monotonic()
+
+    upsert.CHUNK_SIZE = args.chunk_size
+
+    global cache
+
+    if args.cache:
+        cache = ResponseCache()
 
     db_user = getpass.getuser()
     db_passwd = getpass.getpass('数据库密码:')
@@ -223,11 +323,37 @@ if __name__ == "__main__":
 
     logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-    db_init(db_user, db_passwd, db_host, db_name)
+    db_init(db_user, db_passwd, db_host, db_name, args.lean)
 
-    # update= True
-    # do_em_dt(update)
+    # 续跑时 refresh 取断点里保存的; 重新 plan 会因为已经刷新过的基金抓取时间变了而挑出另一批
+    if args.budget and not args.update and not (args.resume and Checkpoint.exists('detail')):
+        refresh = plan(db_session, Fund_Detail, 'detail', args.budget)
+    else:
+        refresh = ()
 
-    do_em_dt(False)
+    try:
+        do_em_dt(args.update, args.concurrency, args.rps, args.resume, refresh)
+    except CircuitOpen as e:
+        # 断点留着, host 恢复后 --resume 接着抓
+        logging.error('detail aborted, rerun with --resume: %s', e)
+        write_metrics('detail', monotonic() - s_time)
+        raise SystemExit(1)
 
-    logging.info('detai cost {:.2f} seconds!'.format(monotonic() - s_time))
+    if args.export:
+        from export import export_table
+        export_table(db_session, Fund_Detail)
+
+    refresh_index(db_session)
+
+    report()
+
+    if cache:
+        cache.report()
+
+    write_metrics('detail', monotonic() - s_time)
+
+    logging.info('detail cost {:.2f} seconds!'.format(monotonic() - s_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from metrics import metrics
+from models import Fund_Digest
+from snapshot import load_index
+from upsert import BulkWriter
+
+
+def payload_digest(data):
+    """Datas 按键排序后序列化再取 SHA1, 与键的顺序和空白无关"""
+
+    s = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(s.encode('UTF-8')).hexdigest()
+
+
+class DigestTracker(object):
+    """比较本次抓到的 Datas 与上次写库时的摘要, 只有新增或变化的基金才需要写库.
+
+    kind 为 'detail' 或 'rate', 对应 fund_digest 表里的一组列.
+    """
+
+    def __init__(self, session, kind):
+        self.kind = kind
+        self.digest_col = kind + '_digest'
+        self.changes_col = kind + '_changes'
+        self.time_col = kind + '_time'
+        self.checked_col = kind + '_checked'
+
+        rows = load_index(session, Fund_Digest.fcode, getattr(Fund_Digest, self.digest_col),
+                          getattr(Fund_Digest, self.changes_col))
+        self.digests = {k: (v[0], v[1] or 0) for k, v in rows.items()}
+        self.writer = BulkWriter(session, Fund_Digest, self.digests)
+
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    def check(self, code, data, exists):
+        """exists 表示目标表里已有该基金, 返回是否需要写库"""
+
+        digest = payload_digest(data)
+        old_digest, changes = self.digests.get(code, (None, 0))
+        now = datetime.now()
+
+        if exists and digest == old_digest:
+            self.unchanged = self.unchanged + 1
+            metrics.inc('rows_total', table='fund_' + self.kind, result='skipped')
+            # 没有变化也记下抓取时间, schedule 据此计算陈旧程度
+            self.writer.add({'fcode': code, self.checked_col: now})
+            return False
+
+        if exists:
+            self.changed = self.changed + 1
+        else:
+            self.new = self.new + 1
+
+        self.writer.add({'fcode': code,
+                         self.digest_col: digest,
+                         self.changes_col: changes + 1,
+                         self.time_col: now,
+                         self.checked_col: now})
+        self.digests[code] = (digest, changes + 1)
+
+        return True
+
+    def flush(self):
+        """在数据行提交之后调用, 中途失败时下次运行会重新写这些基金"""
+
+        self.writer.flush()
+
+    def report(self):
+        logging.info('%s digest new:%d changed:%d unchanged:%d', self.kind, self.new, self.changed, self.unchanged)
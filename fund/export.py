@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import argparse
+import getpass
+import logging
+import os
+import sys
+from time import localtime, monotonic, strftime
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, String, Text
+
+from parsing import parse_amount, parse_date, parse_fee, parse_money_range, parse_percent, parse_period
+
+exportdir = os.path.join(sys.path[0], 'export')
+
+# 按列名指定解析函数和类型, 没列出的列保持字符串
+converters = {
+    'estabdate': (parse_date, 'date'),
+    'fegmrq': (parse_date, 'date'),
+    'endnav': (parse_amount, 'float'),
+    'netnav': (parse_amount, 'float'),
+    'minsg': (parse_amount, 'float'),
+    'mindt': (parse_amount, 'float'),
+    'maxsg': (parse_amount, 'float'),
+    'minssg': (parse_amount, 'float'),
+    'minsbsg': (parse_amount, 'float'),
+    'mgrexp': (parse_percent, 'float'),
+    'trustexp': (parse_percent, 'float'),
+    'salesexp': (parse_percent, 'float'),
+}
+
+# fund_rate 的 sg_money1..5/sg_rate1..5 和 sh_time1..7/sh_rate1..7 合并为两个嵌套列表
+tiers = {
+    'sg': ('money', 5, parse_money_range),
+    'sh': ('time', 7, parse_period),
+}
+
+
+def _pyarrow(what):
+    """pyarrow 和 numpy 导入要上百毫秒, 只在导出和读取快照时导入"""
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('{} needs pyarrow: pip install pyarrow'.format(what))
+
+    return pyarrow, pyarrow.parquet
+
+
+def _arrow_type(pa, name):
+
+    if name == 'tiers':
+        return pa.list_(pa.struct([('lower', pa.float64()), ('upper', pa.float64()),
+                                   ('rate', pa.float64()), ('fixed', pa.float64())]))
+
+    return {'string': pa.string(),
+            'float': pa.float64(),
+            'int': pa.int64(),
+            'date': pa.date32(),
+            'bool': pa.bool_(),
+            'timestamp': pa.timestamp('s')}[name]
+
+
+def _tiers(row, prefix):
+
+    name, count, parse_range = tiers[prefix]
+
+    result = []
+
+    for i in range(1, count + 1):
+        bound = row[prefix + '_' + name + str(i)]
+        fee = row[prefix + '_rate' + str(i)]
+
+        if bound is None and fee is None:
+            continue
+
+        lower, upper = parse_range(bound)
+        rate, fixed = parse_fee(fee)
+
+        result.append({'lower': lower, 'upper': upper, 'rate': rate, 'fixed': fixed})
+
+    return result
+
+
+def _columns(table):
+    """返回 [(列名, 类型, 取值函数)]"""
+
+    columns = []
+    tier_prefixes = []
+
+    for c in table.columns:
+
+        prefix = c.name.split('_')[0]
+
+        if prefix in tiers and c.name[len(prefix) + 1:].rstrip('0123456789') in (tiers[prefix][0], 'rate'):
+            if prefix not in tier_prefixes:
+                tier_prefixes.append(prefix)
+                columns.append((prefix, 'tiers', lambda row, p=prefix: _tiers(row, p)))
+            continue
+
+        if c.name in converters:
+            func, type_name = converters[c.name]
+            columns.append((c.name, type_name, lambda row, n=c.name, f=func: f(row[n])))
+        elif isinstance(c.type, Boolean):
+            columns.append((c.name, 'bool', lambda row, n=c.name: None if row[n] is None else bool(row[n])))
+        elif isinstance(c.type, DateTime):
+            columns.append((c.name, 'timestamp', lambda row, n=c.name: row[n]))
+        elif isinstance(c.type, Float):
+            columns.append((c.name, 'float', lambda row, n=c.name: None if row[n] is None else float(row[n])))
+        elif isinstance(c.type, Integer):
+            columns.append((c.name, 'int', lambda row, n=c.name: row[n]))
+        elif isinstance(c.type, (String, Text)):
+            columns.append((c.name, 'string', lambda row, n=c.name: row[n]))
+        else:
+            raise TypeError('export: no arrow type for {}.{} ({})'.format(table.name, c.name, c.type))
+
+    return columns
+
+
+def export_table(session, model, run_date=None, fmt='arrow'):
+    """把整张表导出成带类型的列式快照: export/run_date=YYYYMMDD/<表名>.arrow(或 .parquet)"""
+
+    pa, pq = _pyarrow('export')
+
+    s_time = monotonic()
+
+    table = model.__table__
+    run_date = run_date or strftime('%Y%m%d', localtime())
+    columns = _columns(table)
+
+    data = {name: [] for name, _, _ in columns}
+
+    result = session.execute(table.select().execution_options(stream_results=True))
+    keys = list(result.keys())
+
+    for row in result:
+        row = dict(zip(keys, row))
+        for name, _, func in columns:
+            data[name].append(func(row))
+
+    schema = pa.schema([(name, _arrow_type(pa, type_name)) for name, type_name, _ in columns])
+    arrow_table = pa.Table.from_pydict(data, schema=schema)
+
+    outdir = os.path.join(exportdir, 'run_date=' + run_date)
+    os.makedirs(outdir, exist_ok=True)
+
+    path = os.path.join(outdir, '{}.{}'.format(table.name, fmt))
+    tmp = path + '.tmp'
+
+    if fmt == 'parquet':
+        pq.write_table(arrow_table, tmp)
+    else:
+        # 不压缩的 Arrow IPC 文件, 读取时可以直接 memory map
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(arrow_table)
+
+    os.replace(tmp, path)
+
+    logging.info('export %s rows:%d -> %s cost %.2f seconds', table.name, arrow_table.num_rows, path, monotonic() - s_time)
+
+    return path
+
+
+def read_snapshot(name, run_date=None, fmt='arrow'):
+    """以 memory map 方式读取快照, run_date 缺省取最近一期"""
+
+    pa, pq = _pyarrow('read_snapshot')
+
+    if run_date is None:
+        runs = sorted(d for d in os.listdir(exportdir) if d.startswith('run_date='))
+        run_date = runs[-1][len('run_date='):]
+
+    path = os.path.join(exportdir, 'run_date=' + run_date, '{}.{}'.format(name, fmt))
+
+    if fmt == 'parquet':
+        return pq.read_table(path, memory_map=True)
+
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+if __name__ == "__main__":
+
+    import fund
+    from logs import setup_logging
+    from models import Fund, Fund_Detail, Fund_Rate
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', default='arrow', choices=['arrow', 'parquet'], help='快照格式')
+    args = parser.parse_args()
+
+    setup_logging('export')
+
+    db_user = getpass.getuser()
+    db_passwd = getpass.getpass('数据库密码:')
+    db_host = os.environ.get('db_host')
+    db_name = 'fintech'
+
+    fund.db_init(db_user, db_passwd, db_host, db_name, lean=True)
+
+    for model in (Fund, Fund_Detail, Fund_Rate):
+        export_table(fund.db_session, model, fmt=args.format)
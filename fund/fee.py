@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import argparse
+import logging
+from time import monotonic
+
+from logs import setup_logging
+from parsing import parse_fee, parse_money_range, parse_percent, parse_period
+
+# 建 FeeTable 时才导入, 见 _numpy
+np = None
+
+SG_TIERS = 5
+SH_TIERS = 7
+
+
+def _numpy():
+    """numpy 导入要几十毫秒, 只在费用计算时导入"""
+
+    global np
+
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError('FeeTable needs numpy: pip install numpy')
+
+        np = numpy
+
+
+class FeeTable(object):
+    """全部基金的费率档位解析成数值数组后做向量化计算.
+
+    sg_* 为申购档位(按金额, 单位元), sh_* 为赎回档位(按持有天数), 均为 [lower, upper) 区间,
+    缺失的档位为 NaN. annual 为管理费 + 托管费 + 销售服务费的年费率.
+    没有任何费率数据的基金费用为 NaN, 排序时排在最后.
+    """
+
+    def __init__(self, codes, sg, sh, annual, known):
+
+        _numpy()
+
+        self.codes = np.array(codes)
+        self.sg_lower, self.sg_upper, self.sg_rate, self.sg_fixed = sg
+        self.sh_lower, self.sh_upper, self.sh_rate, self.sh_fixed = sh
+        self.annual = annual
+        self.known = known
+
+    @classmethod
+    def from_tiers(cls, rows):
+        """rows 为 {'fcode', 'sg', 'sh', 'mgrexp', 'trustexp', 'salesexp'}, 档位与费率已经解析成数值,
+        即 export 快照里的格式"""
+
+        _numpy()
+
+        n = len(rows)
+
+        sg = np.full((4, n, SG_TIERS), np.nan)
+        sh = np.full((4, n, SH_TIERS), np.nan)
+        annual = np.zeros(n)
+        known = np.zeros(n, dtype=bool)
+
+        codes = []
+
+        for i, row in enumerate(rows):
+
+            codes.append(row['fcode'])
+
+            for arr, tiers, count in ((sg, row['sg'], SG_TIERS), (sh, row['sh'], SH_TIERS)):
+                for j, t in enumerate((tiers or [])[:count]):
+                    arr[:, i, j] = [t['lower'], t['upper'], t['rate'], t['fixed']]
+
+            fees = [row[k] for k in ('mgrexp', 'trustexp', 'salesexp') if row[k] is not None]
+
+            annual[i] = sum(fees)
+            known[i] = bool(fees or row['sg'] or row['sh'])
+
+        return cls(codes, sg, sh, annual, known)
+
+    @classmethod
+    def from_rates(cls, rows):
+        """rows 为 fund_rate 表的原始行(字符串字段), 在这里一次性解析"""
+
+        def tiers(row, prefix, name, count, parse_range):
+            result = []
+            for i in range(1, count + 1):
+                bound, fee = row.get('{}_{}{}'.format(prefix, name, i)), row.get('{}_rate{}'.format(prefix, i))
+                if bound is None and fee is None:
+                    continue
+                lower, upper = parse_range(bound)
+                rate, fixed = parse_fee(fee)
+                result.append({'lower': lower, 'upper': upper, 'rate': rate, 'fixed': fixed})
+            return result
+
+        parsed = [{'fcode': row['fcode'],
+                   'sg': tiers(row, 'sg', 'money', SG_TIERS, parse_money_range),
+                   'sh': tiers(row, 'sh', 'time', SH_TIERS, parse_period),
+                   'mgrexp': parse_percent(row.get('mgrexp')),
+                   'trustexp': parse_percent(row.get('trustexp')),
+                   'salesexp': parse_percent(row.get('salesexp'))} for row in rows]
+
+        return cls.from_tiers(parsed)
+
+    @classmethod
+    def from_snapshot(cls, run_date=None):
+        from export import read_snapshot
+
+        table = read_snapshot('fund_rate', run_date)
+        columns = ['fcode', 'sg', 'sh', 'mgrexp', 'trustexp', 'salesexp']
+
+        return cls.from_tiers(table.select(columns).to_pylist())
+
+    @staticmethod
+    def _tier_fee(lower, upper, rate, fixed, x, base):
+        """x 落在哪一档就取哪一档; 有固定费用取固定费用, 否则按费率. 返回 (基金数, 场景数)"""
+
+        # (n, tiers, 1) 与 (1, 1, m) 广播
+        x = x[None, None, :]
+        hit = (lower[:, :, None] <= x) & (x < upper[:, :, None])
+
+        rate = np.where(np.isnan(rate), 0, rate)[:, :, None]
+        fixed = fixed[:, :, None]
+
+        fee = np.where(np.isnan(fixed), base[:, None, :] * rate, fixed)
+
+        return np.where(hit, fee, 0).sum(axis=1)
+
+    def cost(self, amounts, days):
+        """amounts 元买入并持有 days 天的总费用, amounts 与 days 一一对应为多个场景.
+
+        申购费按价外法: 申购费 = 金额 - 金额 / (1 + 费率);
+        持有期间按净申购金额计提年费; 赎回费按赎回时的净值计算, 不考虑收益.
+        返回 (基金数, 场景数) 的数组.
+        """
+
+        amounts = np.atleast_1d(np.asarray(amounts, dtype=float))
+        days = np.atleast_1d(np.asarray(days, dtype=float))
+
+        n = len(self.codes)
+
+        # 金额 - 金额 / (1 + r) 即 金额 * r / (1 + r)
+        sg_rate = np.where(np.isnan(self.sg_rate), 0, self.sg_rate)
+        sub = self._tier_fee(self.sg_lower, self.sg_upper, sg_rate / (1 + sg_rate), self.sg_fixed,
+                             amounts, np.broadcast_to(amounts, (n, len(amounts))))
+
+        net = amounts[None, :] - sub
+        hold = net * self.annual[:, None] * days[None, :] / 365
+
+        red = self._tier_fee(self.sh_lower, self.sh_upper, self.sh_rate, self.sh_fixed,
+                             days, net - hold)
+
+        cost = sub + hold + red
+        cost[~self.known] = np.nan
+
+        return cost
+
+    def rank(self, amount, days, top=20):
+        """单个场景下总费用最低的 top 只基金, 返回 [(代码, 费用)]"""
+
+        cost = self.cost(amount, days)[:, 0]
+        order = np.argsort(cost)[:top]
+
+        return [(str(self.codes[i]), float(cost[i])) for i in order]
+
+
+if __name__ == "__main__":
+
+    setup_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amount', type=float, nargs='+', default=[500000], help='买入金额(元)')
+    parser.add_argument('--days', type=float, nargs='+', default=[400], help='持有天数, 与 --amount 一一对应')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--run-date', help='使用哪一期导出快照, 缺省为最近一期')
+    args = parser.parse_args()
+
+    s_time = monotonic()
+    table = FeeTable.from_snapshot(args.run_date)
+    logging.info('load %d funds cost %.3f seconds', len(table.codes), monotonic() - s_time)
+
+    for amount, days in zip(args.amount, args.days):
+        s_time = monotonic()
+        result = table.rank(amount, days, args.top)
+        logging.info('amount:%.0f days:%.0f cost %.3f seconds', amount, days, monotonic() - s_time)
+        for code, cost in result:
+            print('{}\t{:.2f}'.format(code, cost))
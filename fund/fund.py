@@ -5,104 +5,127 @@ __author__ = 'lidc'
 
 # PYTHONUNBUFFERED=1
 
+import argparse
 import gc
 import getpass
-import json
 import logging
 import os
-# import re
-import sys
-# from pprint import pprint
-from random import randint, random
-from time import monotonic, sleep, strftime, time, localtime
-# from collections import OrderedDict
-from urllib.parse import quote_plus, urlencode
-
-#import demjson
-# import MySQLdb
+from time import monotonic
+from urllib.parse import quote_plus
+
 import requests
-from sqlalchemy import (Boolean, Column, DateTime, Integer, String, create_engine, desc, func, text)
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-s_time = monotonic()
-today = strftime('%Y%m%d', localtime())
+import upsert
+from jsonstream import ArrayStream
+from logs import setup_logging
+from metrics import write_metrics
+from migrate import add_missing_columns
+from models import Base, Fund
+from names import NameIndex, reconcile
+from net import client, conditional_get, configure, fetch_pages, report, save_validator, send
+from snapshot import load_index
+from state import load_state, save_state
+from upsert import BulkWriter
 
-logdir = os.path.join(sys.path[0], 'log')
 
-if not os.path.exists(logdir):
-    os.mkdir(logdir)
+db_session = ''
+db_funds = {}
 
-FORMAT = '[%(asctime)s %(levelname)s]<%(process)d> %(message)s'
-logfile = os.path.join(logdir, '{}_{}.log'.format(os.path.basename(__file__)[:-3], today))
 
-fh = logging.FileHandler(filename=logfile, encoding='UTF-8')
-logging.basicConfig(handlers=[logging.StreamHandler(), fh], format=FORMAT, level=logging.INFO)
+def db_init(db_user, db_passwd, db_host, db_name, lean=False, db_url=None):
+    # engine = create_engine("mysql+mysqldb://{}:{}@{}:3306/{}?charset=utf8mb4&binary_prefix=true".format(
+    # db_url 不为空时直接使用, 例如 bench 用的本地库
+    engine = create_engine(db_url or "mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(
+        db_user, quote_plus(db_passwd), db_host, db_name))
 
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine, Fund)
+    # engine.execute('TRUNCATE TABLE fund')
 
-Base = declarative_base()
+    Session = sessionmaker(bind=engine)
 
+    global db_session
+    db_session = Session()
 
-class Fund(Base):
+    global db_funds
 
-    __tablename__ = 'fund'
+    if lean:
+        # 只载入 code 和两边的名称, 写库时据此判断名称是否变化
+        db_funds = load_index(db_session, Fund.code, Fund.hb_name, Fund.em_name, Fund.score)
+    else:
+        funds = db_session.query(Fund.code, Fund).all()
 
-    code = Column(String(6), primary_key=True, comment='基金代码')
-    hb_name = Column(String(32), comment='好买基金名')
-    em_name = Column(String(32), comment='天天基金名')
-    same = Column(Boolean, comment='是否相同')
+        # 写库统一走 BulkWriter, 载入的对象只作为内存快照
+        db_session.expunge_all()
 
-    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
+        db_funds = dict(funds)
 
-    def __init__(self, code, hb_name, em_name, same):
-        self.code = code
-        self.hb_name = hb_name
-        self.em_name = em_name
-        self.same = same
+    logging.info('db count:%d', len(db_funds))
 
-    def __repr__(self):
-        return "<Fund(code={}, hb_name={}, em_name={}, same={}>".format(self.code, self.hb_name, self.em_name, self.same)
 
+def __names(code):
 
-db_session = ''
-db_funds = {}
+    fund = db_funds.get(code)
 
+    if fund is None:
+        return None, None, None
 
-def db_init(db_user, db_passwd, db_host, db_name):
-    # engine = create_engine("mysql+mysqldb://{}:{}@{}:3306/{}?charset=utf8mb4&binary_prefix=true".format(
-    engine = create_engine("mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(
-        db_user, quote_plus(db_passwd), db_host, db_name))
+    if isinstance(fund, Fund):
+        return fund.hb_name, fund.em_name, fund.score
 
-    Base.metadata.create_all(engine)
-    # engine.execute('TRUNCATE TABLE fund')
+    return fund
 
-    Session = sessionmaker(bind=engine)
 
-    global db_session
-    db_session = Session()
+def __reconcile(writer, code, column, name, discovered=None):
+    """只有名称变化(或两边都有名称却还没有相似度)时才写库, 同时算出 same 和 score.
+    discovered 不为空时, 库里还没有的代码第一次出现时交给它"""
 
-    funds = db_session.query(Fund.code, Fund).all()
+    if discovered is not None and code not in db_funds:
+        discovered(code)
 
-    global db_funds
-    db_funds = dict(funds)
+    hb_name, em_name, score = __names(code)
 
-    logging.info('db count:%d', len(db_funds))
+    if column == 'hb_name':
+        old, hb_name = hb_name, name
+    else:
+        old, em_name = em_name, name
+
+    if code in db_funds and old == name and (score is not None or hb_name is None or em_name is None):
+        return
+
+    same, score = reconcile(hb_name, em_name)
+
+    writer.add({'code': code, column: name, 'same': same, 'score': score})
+
+    db_funds[code] = (hb_name, em_name, score)
 
 
-headers = {'Content-Type': 'application/json; charset=utf-8',
-           'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'}
+def report_near_matches(threshold=0.8):
+    """只在一边出现的基金, 用二元组索引找另一边名称相近的基金"""
 
-s = requests.Session()
-s.headers.update(headers)
+    index = NameIndex()
+    hb_only = []
 
+    for code in db_funds.keys():
+        hb_name, em_name, _ = __names(code)
+        if hb_name is None and em_name is not None:
+            index.add(code, em_name)
+        elif em_name is None and hb_name is not None:
+            hb_only.append((code, hb_name))
 
-def do_howbuy():
+    for code, hb_name in hb_only:
+        for em_code, score in index.near(hb_name, threshold):
+            logging.info('near match: %s %s ~ %s %s score:%.2f', code, hb_name, em_code, index.names[em_code], score)
 
-    hb_url = 'https://www.howbuy.com/fund/fundranking/ajax.htm'
 
-    req = requests.Request('POST', hb_url)
-    prepped = s.prepare_request(req)
-    prepped.headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=utf-8'
+hb_url = 'https://www.howbuy.com/fund/fundranking/ajax.htm'
+em_web_url = 'http://fund.eastmoney.com/js/fundcode_search.js'
+em_wap_url = 'https://m.1234567.com.cn/data/FundSuggestList.js'
+
+
+def do_howbuy(window=4, rps=5, discovered=None):
 
     payload = {}
     payload['orderField'] = ''
@@ -115,103 +138,122 @@ def do_howbuy():
     payload['page'] = 1
     payload['cat'] = 'index.htm'
 
-    items = []
-    i = 0
+    def fetch(page):
 
-    while True:
+        req = requests.Request('POST', hb_url)
+        prepped = client().prepare_request(req)
+        prepped.headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=utf-8'
 
-        i = i + 1
+        prepped.prepare_body(dict(payload, page=page), None)
+        r, (body, j) = send(client(), prepped)
 
-        payload['page'] = i
+        return j['list']
 
-        prepped.prepare_body(payload, None)
-        r = s.send(prepped)
+    writer = BulkWriter(db_session, Fund, db_funds)
 
-        online_funds = r.json()['list']
-
-        if not online_funds:
-            break
+    def handle(page, online_funds):
 
         for j in online_funds:
-            if j['jjdm'] in db_funds:
-                db_funds[j['jjdm']].hb_name = j['jjjc']
-            else:
-                fund = Fund(j['jjdm'], j['jjjc'], None, None)
-                items.append(fund)
-                db_funds[j['jjdm']] = fund
-
-        if i == 1000:
-            db_session.add_all(items)
-            db_session.commit()
-            items.clear()
+            __reconcile(writer, j['jjdm'], 'hb_name', j['jjjc'], discovered)
+
+        if len(writer) >= 1000:
+            writer.flush()
             gc.collect()
 
             logging.info('hb commit 1k')
 
-        sleep(random())
+    known_pages = load_state('howbuy', {}).get('pages', 0)
 
-    db_session.add_all(items)
-    db_session.commit()
+    configure(hb_url, window, rps)
 
-    logging.info('hb upsert over!')
+    pages = fetch_pages(fetch, handle, window, known_pages)
 
+    writer.flush()
 
-def do_eastmoney_web():
+    save_state('howbuy', {'pages': pages})
 
-    em_url = 'http://fund.eastmoney.com/js/fundcode_search.js'
+    logging.info('hb upsert over! pages:%d', pages)
 
-    req = requests.Request('GET', em_url)
-    prepped = s.prepare_request(req)
 
-    r = s.send(prepped)
+def do_eastmoney_web(discovered=None):
 
-    obj_array = json.loads(r.text[8:-1])
+    r = conditional_get(client(), em_web_url, stream=True)
 
-    items = []
+    if r is None:
+        logging.info('em_web not modified, skip!')
+        return
+
+    # var r = [["000001","HXCZHH","华夏成长混合","混合型","HUAXIACHENGZHANGHUNHE"],...];
+    obj_array = ArrayStream(r.iter_content(64 * 1024))
+
+    writer = BulkWriter(db_session, Fund, db_funds)
 
     for j in obj_array:
-        if j[0] in db_funds:
-            db_funds[j[0]].em_name = j[2]
-        else:
-            fund = Fund(j[0], None, j[2], None)
-            items.append(fund)
-            db_funds[j[0]] = fund
+        __reconcile(writer, j[0], 'em_name', j[2], discovered)
 
-    db_session.add_all(items)
-    db_session.commit()
+        if len(writer) >= 1000:
+            writer.flush()
 
-    logging.info('em_web upsert over!')
+    writer.flush()
 
+    obj_array.report('em_web')
 
-def do_eastmoney_wap():
+    save_validator(em_web_url, r)
+
+    logging.info('em_web upsert over!')
 
-    em_url = 'https://m.1234567.com.cn/data/FundSuggestList.js'
 
-    req = requests.Request('GET', em_url)
-    prepped = s.prepare_request(req)
+def do_eastmoney_wap(discovered=None):
 
-    r = s.send(prepped)
+    r = conditional_get(client(), em_wap_url, stream=True)
 
-    obj = json.loads(r.text[16:-3])
+    if r is None:
+        logging.info('em_wap not modified, skip!')
+        return
 
-    items = []
+    # FundSuggestList({"Datas":["000001|HXCZHH|华夏成长混合|...",...],...});
+    obj = ArrayStream(r.iter_content(64 * 1024), '"Datas"')
 
-    for o in obj['Datas']:
+    writer = BulkWriter(db_session, Fund, db_funds)
+
+    for o in obj:
         j = o.split('|')
-        if j[0] in db_funds:
-            db_funds[j[0]].em_name = j[2]
-        else:
-            fund = Fund(j[0], None, j[2], None)
-            items.append(fund)
-            db_funds[j[0]] = fund
+        __reconcile(writer, j[0], 'em_name', j[2], discovered)
+
+        if len(writer) >= 1000:
+            writer.flush()
 
-    db_session.add_all(items)
-    db_session.commit()
+    writer.flush()
+
+    obj.report('em_wap')
+
+    save_validator(em_wap_url, r)
 
     logging.info('em_wap upsert over!')
 
 
-if __name__ == "__main__":
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--window', type=int, default=4, help='好买排行同时在途的页数')
+    parser.add_argument('--rps', type=float, default=5, help='好买排行每秒最多请求数')
+    parser.add_argument('--chunk-size', type=int, default=upsert.CHUNK_SIZE, help='每条 INSERT 语句的行数')
+    parser.add_argument('--lean', action='store_true', help='只载入主键索引, 不把整张表的对象放在内存里')
+    parser.add_argument('--export', action='store_true', help='抓取结束后导出列式快照')
+    args = parser.parse_args(argv)
+
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+
+    from search import refresh_index
+    from service import notify_on_commit
+
+    setup_logging('fund')
+    notify_on_commit()
+
+    s_time = monotonic()
+
+    upsert.CHUNK_SIZE = args.chunk_size
 
     db_user = getpass.getuser()
     db_passwd = getpass.getpass('数据库密码:')
@@ -220,17 +262,29 @@ if __name__ == "__main__":
 
     logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-    db_init(db_user, db_passwd, db_host, db_name)
+    db_init(db_user, db_passwd, db_host, db_name, args.lean)
 
-    do_howbuy()
+    do_howbuy(args.window, args.rps)
 
     # do_eastmoney_web()
     do_eastmoney_wap()
 
-    db_session.execute('UPDATE {} SET same=1 WHERE hb_name=em_name;'.format(Fund.__tablename__))
-    db_session.execute('UPDATE {} SET same=0 WHERE same<>1 or same is null;'.format(Fund.__tablename__))
+    report_near_matches()
+
+    report()
+
+    if args.export:
+        from export import export_table
+        export_table(db_session, Fund)
+
+    refresh_index(db_session)
 
-    db_session.commit()
     db_session.close()
 
+    write_metrics('fund', monotonic() - s_time)
+
     logging.info('fund cost {:.2f} seconds!'.format(monotonic() - s_time))
+
+
+if __name__ == "__main__":
+    main()
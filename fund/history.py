@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# fund_detail/fund_rate 的字段级变化历史. 每次写库前和库里的旧行比较, 只记下变了的列:
+#
+#   (kind, fcode, field, value, valid_from)   value 为 JSON 编码的新值
+#
+# 某只基金第一次进入历史时, 先把库里的旧行整行记为基线(initial, valid_from 为旧行的 update_time),
+# 之后只记变化. 某个时刻的状态 = 该时刻之前每列最后一次记录的值.
+
+import argparse
+import getpass
+import json
+import logging
+import os
+from datetime import datetime
+from urllib.parse import quote_plus
+
+from sqlalchemy import text
+
+from metrics import metrics
+from models import Fund_History
+
+# 赎回费率表
+REDEMPTION = tuple('sh_{}{}'.format(name, i) for i in range(1, 8) for name in ('time', 'rate'))
+
+# 申购费率表
+PURCHASE = tuple('sg_{}{}'.format(name, i) for i in range(1, 6) for name in ('money', 'rate'))
+
+FIELDS = {'redemption': REDEMPTION, 'purchase': PURCHASE}
+
+# 不进入历史的列
+IGNORED = ('update_time',)
+
+
+def _encode(value):
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+
+class History(object):
+    """挂在 BulkWriter 上, 在数据行写库之前把每行和库里的旧行比较, 变化的列写入 fund_history.
+    与数据行在同一个事务里提交"""
+
+    def __init__(self, session, kind):
+        self.session = session
+        self.kind = kind
+
+        # 已经有基线的基金
+        self.tracked = {code for code, in session.execute(text('SELECT DISTINCT fcode FROM fund_history WHERE kind=:kind'),
+                                                        {'kind': kind})}
+
+        self.changes = 0
+
+    def record(self, table, rows, chunk=1000):
+
+        key = list(table.primary_key)[0]
+        now = datetime.now()
+
+        old = {}
+        codes = [row[key.name] for row in rows]
+        for i in range(0, len(codes), chunk):
+            result = self.session.execute(table.select().where(key.in_(codes[i:i + chunk])))
+            names = list(result.keys())
+            for r in result:
+                r = dict(zip(names, r))
+                old[r[key.name]] = r
+
+        history = []
+
+        for row in rows:
+
+            code = row[key.name]
+            before = old.get(code)
+
+            if before is None or code not in self.tracked:
+                # 新基金以本次的值为基线; 已有的基金以库里的旧行为基线, 再比较本次的变化
+                base = before if before is not None else row
+                since = (before or {}).get('update_time') or now
+                history.extend({'kind': self.kind, 'fcode': code, 'field': field, 'value': _encode(value),
+                                'initial': True, 'valid_from': since}
+                               for field, value in base.items()
+                               if field != key.name and field not in IGNORED and value is not None)
+                self.tracked.add(code)
+
+                if before is None:
+                    continue
+
+            for field, value in row.items():
+                if field == key.name or field in IGNORED or before.get(field) == value:
+                    continue
+                history.append({'kind': self.kind, 'fcode': code, 'field': field, 'value': _encode(value),
+                                'initial': False, 'valid_from': now})
+                self.changes = self.changes + 1
+
+        if history:
+            self.session.execute(Fund_History.__table__.insert(), history)
+
+        metrics.inc('history_rows_total', len(history), kind=self.kind)
+
+        logging.info('fund_history batch: %s rows:%d', self.kind, len(history))
+
+
+def as_of(session, kind, code, when):
+    """code 在 when 时刻的 {列: 值}; 只扫该基金自己的版本"""
+
+    state = {}
+
+    for field, value in session.execute(text('SELECT field, value FROM fund_history '
+                                             'WHERE kind=:kind AND fcode=:code AND valid_from<=:when ORDER BY valid_from, id'),
+                                        {'kind': kind, 'code': code, 'when': when}):
+        state[field] = None if value is None else json.loads(value)
+
+    return state
+
+
+def changed_between(session, kind, fields, start, end):
+    """(start, end] 之间 fields 中任一列发生变化的基金代码; 按 (kind, field, valid_from) 索引逐列范围扫描"""
+
+    codes = set()
+
+    for field in fields:
+        codes.update(code for code, in session.execute(
+            text('SELECT DISTINCT fcode FROM fund_history '
+                 'WHERE kind=:kind AND field=:field AND valid_from>:start AND valid_from<=:end AND NOT initial'),
+            {'kind': kind, 'field': field, 'start': start, 'end': end}))
+
+    return codes
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='action')
+    sub.required = True
+
+    p = sub.add_parser('as-of', help='某只基金在某个时刻的详情或费率')
+    p.add_argument('code')
+    p.add_argument('when', help='YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS')
+
+    p = sub.add_parser('changed', help='两个时刻之间某组字段变化过的基金')
+    p.add_argument('start')
+    p.add_argument('end')
+    p.add_argument('--fields', default='redemption', help='redemption, purchase 或逗号分隔的列名')
+
+    parser.add_argument('--kind', default='rate', choices=['detail', 'rate'])
+    args = parser.parse_args(argv)
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from logs import setup_logging
+
+    setup_logging()
+
+    db_user = getpass.getuser()
+    db_passwd = getpass.getpass('数据库密码:')
+    db_host = os.environ.get('db_host')
+    db_name = 'fintech'
+
+    engine = create_engine("mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(
+        db_user, quote_plus(db_passwd), db_host, db_name))
+    session = sessionmaker(bind=engine)()
+
+    if args.action == 'as-of':
+        for field, value in sorted(as_of(session, args.kind, args.code, datetime.fromisoformat(args.when)).items()):
+            print('{}\t{}'.format(field, value))
+    else:
+        fields = FIELDS.get(args.fields) or args.fields.split(',')
+        codes = changed_between(session, args.kind, fields, datetime.fromisoformat(args.start), datetime.fromisoformat(args.end))
+        logging.info('%s %s changed: %d funds', args.kind, args.fields, len(codes))
+        for code in sorted(codes):
+            print(code)
+
+
+if __name__ == "__main__":
+    main()
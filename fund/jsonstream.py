@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import codecs
+import json
+import logging
+from time import monotonic
+
+from metrics import metrics
+
+
+class ArrayStream(object):
+    """从响应体的字节块中逐个解析出 JSON 数组的元素, 内存占用只与单个元素和块大小有关.
+
+    marker 为数组之前的一段文本(例如 '"Datas"'), 为 None 时取遇到的第一个数组.
+    迭代结束后 bytes/items/parse_time 记录了解析的数据量和耗时, parse_time 不含等待网络的 read_time.
+    """
+
+    def __init__(self, chunks, marker=None):
+        self.chunks = iter(chunks)
+        self.marker = marker
+        self.decoder = codecs.getincrementaldecoder('UTF-8')()
+        self.buf = ''
+        self.eof = False
+
+        self.bytes = 0
+        self.items = 0
+        self.elapsed = 0.0
+        self.read_time = 0.0
+
+    @property
+    def parse_time(self):
+        return self.elapsed - self.read_time
+
+    def _more(self):
+
+        if self.eof:
+            return False
+
+        t = monotonic()
+        chunk = next(self.chunks, None)
+        self.read_time = self.read_time + monotonic() - t
+
+        if chunk is None:
+            self.eof = True
+            self.buf = self.buf + self.decoder.decode(b'', final=True)
+        else:
+            self.bytes = self.bytes + len(chunk)
+            self.buf = self.buf + self.decoder.decode(chunk)
+
+        return True
+
+    def _find(self, s):
+        """在缓冲区里找 s, 找不到就继续读; 返回 s 之后的位置"""
+
+        while True:
+            pos = self.buf.find(s)
+            if pos >= 0:
+                return pos + len(s)
+            # 丢掉已经查过的部分, 保留可能跨块的尾巴
+            keep = len(s) - 1
+            self.buf = self.buf[-keep:] if keep else ''
+            if not self._more():
+                raise ValueError('{} not found in stream'.format(s))
+
+    def __iter__(self):
+
+        decoder = json.JSONDecoder()
+        t = monotonic()
+
+        if self.marker:
+            pos = self._find(self.marker)
+            self.buf = self.buf[pos:]
+        pos = self._find('[')
+
+        while True:
+
+            while pos >= len(self.buf) or self.buf[pos] in ' \t\r\n,':
+                if pos >= len(self.buf):
+                    self.buf = ''
+                    pos = 0
+                    if not self._more():
+                        raise ValueError('unexpected end of stream')
+                else:
+                    pos = pos + 1
+
+            if self.buf[pos] == ']':
+                break
+
+            try:
+                item, pos = decoder.raw_decode(self.buf, pos)
+            except ValueError:
+                # 元素被块边界截断, 丢掉已消费的部分, 读入下一块再试
+                self.buf = self.buf[pos:]
+                pos = 0
+                if not self._more():
+                    raise
+                continue
+
+            self.items = self.items + 1
+            self.elapsed = self.elapsed + monotonic() - t
+
+            yield item
+
+            t = monotonic()
+
+        self.elapsed = self.elapsed + monotonic() - t
+
+    def report(self, name):
+
+        metrics.inc('download_bytes_total', self.bytes, stage=name)
+        metrics.inc('parse_seconds_total', self.parse_time, stage=name)
+
+        logging.info('%s parsed %d records, %.1f KB in %.3f seconds (%.1f MB/s)',
+                     name, self.items, self.bytes / 1024, self.parse_time,
+                     self.bytes / 1024 / 1024 / self.parse_time if self.parse_time else 0)
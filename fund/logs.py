@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import logging
+import os
+import sys
+from time import localtime, strftime
+
+logdir = os.path.join(sys.path[0], 'log')
+
+FORMAT = '[%(asctime)s %(levelname)s]<%(process)d> %(message)s'
+
+
+def setup_logging(name=None):
+    """输出到终端; 给出 name 时同时写 log/<name>_<日期>.log. 由入口脚本调用, 导入模块时不配置日志"""
+
+    handlers = [logging.StreamHandler()]
+
+    if name:
+        if not os.path.exists(logdir):
+            os.mkdir(logdir)
+
+        logfile = os.path.join(logdir, '{}_{}.log'.format(name, strftime('%Y%m%d', localtime())))
+        handlers.append(logging.FileHandler(filename=logfile, encoding='UTF-8'))
+
+    logging.basicConfig(handlers=handlers, format=FORMAT, level=logging.INFO)
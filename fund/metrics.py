@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 一次运行内的计数器和直方图, 结束时写成 Prometheus textfile 和 JSON 报告
+
+import json
+import logging
+import os
+import sys
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import localtime, monotonic, strftime, time
+
+PREFIX = 'fintech_'
+
+# 秒
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metricsdir = os.path.join(sys.path[0], 'metrics')
+
+HELP = {
+    'http_request_seconds': '请求耗时, 重试的每一次单独计入',
+    'http_retries_total': '重试次数',
+    'fetch_failed_total': '重试之后仍然失败、被跳过的请求',
+    'http_wait_seconds_total': '限速(throttle)和退避(backoff)等待的时间',
+    'download_bytes_total': '下载的响应体字节数',
+    'parse_seconds_total': '解析 JSON 的时间, 不含等待网络',
+    'db_flush_seconds': '每批 INSERT 语句的执行时间, 不含提交',
+    'db_commit_seconds': '每批的提交时间',
+    'history_rows_total': '写入 fund_history 的行数, 含首次的基线',
+    'schema_drift_total': '接口字段的漂移: 缺少声明的字段(missing), 相对第一条记录多出(new)或少了(gone)的键, 类型变化(type)',
+    'rows_total': '写入结果: inserted/updated/unchanged, 摘要未变未写入的为 skipped',
+    'import_seconds': '入口导入加载模块的耗时(冷启动)',
+    'run_seconds': '本次运行总耗时',
+    'run_timestamp_seconds': '本次运行结束的时间',
+}
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def quantile(self, q):
+        """在所在的桶内线性插值估计分位数, 与 Prometheus 的 histogram_quantile 一致"""
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen = seen + n
+            lower = bound
+
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    """按 (名称, 标签) 累加, 可在多个线程中调用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - t, **labels)
+
+    def textfile(self):
+        """Prometheus 文本格式"""
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + '}'
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in HELP:
+                    lines.append('# HELP {}{} {}'.format(PREFIX, name, HELP[name]))
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, 'counter')
+                lines.append('{}{}{} {}'.format(PREFIX, name, fmt(labels), value))
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, 'gauge')
+                lines.append('{}{}{} {}'.format(PREFIX, name, fmt(labels), value))
+
+            for (name, labels), h in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                seen = 0
+                for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                    seen = seen + n
+                    lines.append('{}{}_bucket{} {}'.format(PREFIX, name, fmt(labels, [('le', bound)]), seen))
+                lines.append('{}{}_sum{} {}'.format(PREFIX, name, fmt(labels), h.sum))
+                lines.append('{}{}_count{} {}'.format(PREFIX, name, fmt(labels), h.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """JSON 报告, 直方图给出次数/总和/p50/p99"""
+
+        def entry(name, labels, **values):
+            return dict(name=name, labels=dict(labels), **values)
+
+        with self.lock:
+            return {
+                'counters': [entry(n, l, value=v) for (n, l), v in sorted(self.counters.items())],
+                'gauges': [entry(n, l, value=v) for (n, l), v in sorted(self.gauges.items())],
+                'histograms': [entry(n, l, count=h.count, sum=h.sum, p50=h.quantile(0.5), p99=h.quantile(0.99))
+                               for (n, l), h in sorted(self.histograms.items())],
+            }
+
+
+metrics = Metrics()
+
+
+def endpoint(url):
+    """去掉查询参数的 host + path, 作为 endpoint 标签"""
+
+    return url.split('://', 1)[-1].split('?', 1)[0]
+
+
+def write_metrics(job, elapsed):
+    """写 metrics/<job>.prom(供 node_exporter textfile collector 收集)和 metrics/<job>_<时间>.json"""
+
+    metrics.set('run_seconds', elapsed, job=job)
+    metrics.set('run_timestamp_seconds', time(), job=job)
+
+    if not os.path.exists(metricsdir):
+        os.mkdir(metricsdir)
+
+    # 先写临时文件再改名, collector 不会读到写了一半的文件
+    prom = os.path.join(metricsdir, '{}.prom'.format(job))
+    with open(prom + '.tmp', 'w', encoding='UTF-8') as f:
+        f.write(metrics.textfile())
+    os.replace(prom + '.tmp', prom)
+
+    report = os.path.join(metricsdir, '{}_{}.json'.format(job, strftime('%Y%m%d_%H%M%S', localtime())))
+    with open(report, 'w', encoding='UTF-8') as f:
+        json.dump(metrics.report(), f, ensure_ascii=False, indent=1)
+
+    logging.info('metrics written to %s and %s', prom, report)
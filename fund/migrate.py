@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+
+def add_missing_columns(engine, model):
+    """create_all 不会修改已存在的表, 模型里新增的列在这里补上"""
+
+    table = model.__table__
+    existing = {c['name'] for c in inspect(engine).get_columns(table.name)}
+
+    for column in table.columns:
+        if column.name not in existing:
+            ddl = 'ALTER TABLE {} ADD COLUMN {}'.format(table.name, CreateColumn(column).compile(dialect=engine.dialect))
+            logging.info(ddl)
+            engine.execute(ddl)
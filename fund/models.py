@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 所有表共用一个 Base. 只依赖 sqlalchemy, 导入时不建目录、不开日志文件、不连网络
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Index, Integer, String, Text, text
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class Fund(Base):
+
+    __tablename__ = 'fund'
+
+    code = Column(String(6), primary_key=True, comment='基金代码')
+    hb_name = Column(String(32), comment='好买基金名')
+    em_name = Column(String(32), comment='天天基金名')
+    same = Column(Boolean, comment='是否相同')
+    score = Column(Float, comment='名称相似度')
+
+    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
+
+    def __init__(self, code, hb_name, em_name, same):
+        self.code = code
+        self.hb_name = hb_name
+        self.em_name = em_name
+        self.same = same
+
+    def __repr__(self):
+        return "<Fund(code={}, hb_name={}, em_name={}, same={}>".format(self.code, self.hb_name, self.em_name, self.same)
+
+
+class Fund_Detail(Base):
+
+    __tablename__ = 'fund_detail'
+
+    fcode = Column(String(8), primary_key=True, comment='基金代码')
+    feature = Column(String(32), comment='')
+    cycle = Column(String(4), comment='')
+    webbackcode = Column(String(8), comment='基金代码(后端)')
+    shortname = Column(String(32), comment='基金简称')
+    fullname = Column(String(64), comment='基金全称')
+    ftype = Column(String(8), comment='基金类型')
+    estabdate = Column(String(16), comment='成立日期')
+    endnav = Column(String(16), comment='资产规模')
+    fegmrq = Column(String(16), comment='规模截止日期')
+    rlevel_sz = Column(String(4), comment='基金评级')
+    risklevel = Column(String(4), comment='风险等级')
+    jjgs = Column(String(16), comment='基金管理人')
+    tgyh = Column(String(8), comment='基金托管人')
+    jjgsid = Column(String(8), comment='基金管理人代码')
+    jjjl = Column(String(32), comment='基金经理人')
+    netnav = Column(String(16), comment='成立规模')
+    bench = Column(String(160), comment='业绩比较基准')
+    indexcode = Column(String(16), comment='跟踪标的代码')
+    indexname = Column(String(64), comment='跟踪标的')
+    prsvperiod = Column(String(4), comment='')
+    prsvdate = Column(String(32), comment='')
+    prsvtype = Column(String(4), comment='')
+    buytime = Column(String(8), comment='')
+    mgrexp = Column(String(8), comment='管理费率')
+    trustexp = Column(String(8), comment='托管费率')
+    salesexp = Column(String(8), comment='销售服务费率')
+
+    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
+
+    # def __eq__(self,other):
+    #     return self.__dict__ == other.__dict__
+
+
+class Fund_Rate(Base):
+
+    __tablename__ = 'fund_rate'
+
+    fcode = Column(String(8), primary_key=True, comment='基金代码')
+    sgzt = Column(String(4), comment='申购状态')
+    shzt = Column(String(4), comment='赎回状态')
+    dtzt = Column(Boolean, comment='定投状态')
+    minsg = Column(String(16), comment='申购起点')
+    mindt = Column(String(16), comment='定投起点')
+    maxsg = Column(String(16), comment='日累计申购限额')
+    minssg = Column(String(16), comment='首次购买')
+    minsbsg = Column(String(16), comment='追加购买')
+    ssbcfmdata = Column(String(4), comment='买入确认日')
+    rdmcfmdata = Column(String(4), comment='卖出确认日')
+    mgrexp = Column(String(8), comment='管理费率')
+    trustexp = Column(String(8), comment='托管费率')
+    salesexp = Column(String(8), comment='销售服务费率')
+
+    sg_money1 = Column(String(16), comment='申购金额1')
+    sg_rate1 = Column(String(8), comment='申购费率1')
+    sg_money2 = Column(String(32), comment='申购金额2')
+    sg_rate2 = Column(String(8), comment='申购费率2')
+    sg_money3 = Column(String(32), comment='申购金额3')
+    sg_rate3 = Column(String(8), comment='申购费率3')
+    sg_money4 = Column(String(32), comment='申购金额4')
+    sg_rate4 = Column(String(8), comment='申购费率4')
+    sg_money5 = Column(String(16), comment='申购金额5')
+    sg_rate5 = Column(String(8), comment='申购费率5')
+
+    sh_time1 = Column(String(512), comment='持有期限1')
+    sh_rate1 = Column(String(8), comment='赎回费率1')
+    sh_time2 = Column(String(512), comment='持有期限2')
+    sh_rate2 = Column(String(8), comment='赎回费率2')
+    sh_time3 = Column(String(128), comment='持有期限3')
+    sh_rate3 = Column(String(8), comment='赎回费率3')
+    sh_time4 = Column(String(64), comment='持有期限4')
+    sh_rate4 = Column(String(8), comment='赎回费率4')
+    sh_time5 = Column(String(32), comment='持有期限5')
+    sh_rate5 = Column(String(8), comment='赎回费率5')
+    sh_time6 = Column(String(32), comment='持有期限6')
+    sh_rate6 = Column(String(8), comment='赎回费率6')
+    sh_time7 = Column(String(16), comment='持有期限7')
+    sh_rate7 = Column(String(8), comment='赎回费率7')
+
+    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
+
+
+class Fund_Digest(Base):
+
+    __tablename__ = 'fund_digest'
+
+    fcode = Column(String(8), primary_key=True, comment='基金代码')
+    detail_digest = Column(String(40), comment='详情摘要')
+    detail_changes = Column(Integer, comment='详情变化次数')
+    detail_time = Column(DateTime, comment='详情变化时间')
+    rate_digest = Column(String(40), comment='费率摘要')
+    rate_changes = Column(Integer, comment='费率变化次数')
+    rate_time = Column(DateTime, comment='费率变化时间')
+    detail_checked = Column(DateTime, comment='详情最近抓取时间')
+    rate_checked = Column(DateTime, comment='费率最近抓取时间')
+
+    create_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), comment='创建时间')
+
+
+class Crawl_Shard(Base):
+
+    __tablename__ = 'crawl_shard'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(8), comment='detail 或 rate')
+    run = Column(String(16), comment='入队批次')
+    shard = Column(Integer, comment='批次内的分片序号')
+    codes = Column(Text, comment='逗号分隔的基金代码')
+    status = Column(String(8), comment='pending/leased/done/failed')
+    owner = Column(String(64), comment='持有租约的 worker, 主机名:进程号')
+    token = Column(String(32), comment='本次领取的凭据, 续约和完成时校验')
+    attempts = Column(Integer, comment='领取次数')
+    lease_until = Column(DateTime, comment='租约到期时间, 以数据库时间为准')
+    done_time = Column(DateTime, comment='完成时间')
+
+    create_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), comment='创建时间')
+
+    __table_args__ = (Index('crawl_shard_claim', 'kind', 'status', 'id'), Index('crawl_shard_token', 'token'))
+
+
+class Fund_History(Base):
+
+    __tablename__ = 'fund_history'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(8), comment='detail 或 rate')
+    fcode = Column(String(8), comment='基金代码')
+    field = Column(String(16), comment='变化的列')
+    value = Column(Text, comment='新值, JSON 编码, null 表示清空')
+    initial = Column(Boolean, comment='首次记录的基线, 不算变化')
+    valid_from = Column(DateTime, comment='从何时起为该值')
+
+    __table_args__ = (Index('fund_history_asof', 'kind', 'fcode', 'valid_from'),
+                      Index('fund_history_field', 'kind', 'field', 'valid_from'))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import re
+import unicodedata
+from collections import defaultdict
+
+# 份额类别后缀, 如 "华夏成长混合A" 与 "华夏成长混合C"
+_share_class = re.compile(r'[A-Z]$')
+_spaces = re.compile(r'\s+')
+
+NEAR = 0.8
+
+
+def normalize(name):
+    """全角转半角(NFKC), 去空白, 统一大写"""
+
+    if not name:
+        return ''
+
+    return _spaces.sub('', unicodedata.normalize('NFKC', name)).upper()
+
+
+def bigrams(name):
+
+    if len(name) < 2:
+        return {name} if name else set()
+
+    return {name[i:i + 2] for i in range(len(name) - 1)}
+
+
+def similarity(a, b):
+    """规范化后的字符二元组 Dice 系数, 0 到 1; 只差份额类别后缀时不低于 NEAR"""
+
+    a = normalize(a)
+    b = normalize(b)
+
+    if not a or not b:
+        return 0.0
+
+    if a == b:
+        return 1.0
+
+    ga = bigrams(a)
+    gb = bigrams(b)
+
+    score = 2.0 * len(ga & gb) / (len(ga) + len(gb))
+
+    if _share_class.sub('', a) == _share_class.sub('', b):
+        score = max(score, NEAR)
+
+    return score
+
+
+def reconcile(hb_name, em_name):
+    """返回 (same, score), same 与原来 SQL 中 hb_name=em_name 的判断一致"""
+
+    same = hb_name is not None and hb_name == em_name
+    score = similarity(hb_name, em_name) if hb_name is not None and em_name is not None else None
+
+    return same, score
+
+
+class NameIndex(object):
+    """字符二元组倒排索引, 只对至少共享一个二元组的候选计算相似度"""
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        # 去掉份额类别后缀后的名称 -> 代码
+        self.stems = defaultdict(set)
+        self.names = {}
+
+    def add(self, code, name):
+
+        self.remove(code)
+
+        name = normalize(name)
+        if not name:
+            return
+
+        self.names[code] = name
+        self.stems[_share_class.sub('', name)].add(code)
+        for g in bigrams(name):
+            self.postings[g].add(code)
+
+    def remove(self, code):
+
+        name = self.names.pop(code, None)
+        if name is None:
+            return
+
+        self.stems[_share_class.sub('', name)].discard(code)
+        for g in bigrams(name):
+            self.postings[g].discard(code)
+
+    def near(self, name, threshold=NEAR, limit=5):
+        """返回 [(code, score)], 按相似度从高到低"""
+
+        name = normalize(name)
+        grams = bigrams(name)
+
+        counts = defaultdict(int)
+        for g in grams:
+            for code in self.postings.get(g, ()):
+                counts[code] = counts[code] + 1
+
+        # 只差份额类别后缀的, similarity 会提到 NEAR, 不参与下面的剪枝, 也不要求共享二元组
+        siblings = self.stems.get(_share_class.sub('', name), ())
+        for code in siblings:
+            counts[code] = counts[code]
+
+        # Dice 系数的上界为 2 * 共享数 / (len(grams) + 共享数), 先用它剪枝
+        result = []
+        for code, shared in counts.items():
+            if code not in siblings and 2.0 * shared / (len(grams) + shared) < threshold:
+                continue
+            score = similarity(name, self.names[code])
+            if score >= threshold:
+                result.append((code, score))
+
+        result.sort(key=lambda x: -x[1])
+
+        return result[:limit]
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 每日净值历史: 只抓每只基金上次存储日期之后的净值, 追加写入按月分区的 Arrow 文件.
+#
+#   nav/month=YYYYMM/part-<批次>.arrow   不压缩的 Arrow IPC 文件, 只追加不改写, 按 (fcode, date) 排序
+#   nav/index.db                         sqlite: 每只基金在每个文件里的行区间, 以及每个文件的日期范围
+#
+# 一只基金的完整序列按索引只切出自己的行区间; 某一天的全部基金只读日期范围覆盖这一天的文件.
+
+import argparse
+import getpass
+import logging
+import os
+import sqlite3
+import sys
+from collections import defaultdict
+from datetime import date
+from time import localtime, monotonic, strftime
+
+from metrics import metrics, write_metrics
+from net import client, fetch_all
+from parsing import parse_date
+
+# NavStore 创建时才导入, 见 _pyarrow
+pa = None
+pc = None
+
+navdir = os.path.join(sys.path[0], 'nav')
+
+nav_url = 'https://fundmobapi.eastmoney.com/FundMApi/FundMNHisNetList.ashx?FCODE={}&IsShareNet=true&pageIndex={}&pagesize={}&deviceid=Wap&plat=Wap&product=EFund&version=2.0.0'
+
+# 没有历史时一次取的条数, 超过的部分按页继续取
+BACKFILL = 5000
+
+# 一次抓取并写入的基金数; 一组里未写入的行都在内存里
+GROUP = 100
+
+
+def _pyarrow():
+    """pyarrow 和 numpy 导入要上百毫秒, 只在写入和读取净值时导入"""
+
+    global pa, pc
+
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.compute
+        except ImportError:
+            raise RuntimeError('nav needs pyarrow: pip install pyarrow')
+
+        pa, pc = pyarrow, pyarrow.compute
+
+
+def _schema():
+    return pa.schema([('fcode', pa.string()), ('date', pa.date32()),
+                      ('nav', pa.float64()), ('acc_nav', pa.float64()), ('growth', pa.float64())])
+
+
+def _float(s):
+
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+class NavStore(object):
+    """按月分区的净值文件和它们的 sqlite 索引. 只能在创建它的线程里使用"""
+
+    def __init__(self, path=None):
+
+        _pyarrow()
+
+        self.path = path or navdir
+        os.makedirs(self.path, exist_ok=True)
+
+        self.conn = sqlite3.connect(os.path.join(self.path, 'index.db'))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, first TEXT, last TEXT, rows INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_range ON files (first, last)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS segments ('
+                          'fcode TEXT, path TEXT, offset INTEGER, length INTEGER, first TEXT, last TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS segments_fcode ON segments (fcode, first)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS latest (fcode TEXT PRIMARY KEY, last TEXT)')
+        self.conn.commit()
+
+        self.rows = []
+        self.batches = 0
+
+    def latest(self):
+        """{fcode: 已存储的最后日期}"""
+
+        return {code: date.fromisoformat(last) for code, last in self.conn.execute('SELECT fcode, last FROM latest')}
+
+    def add(self, code, d, nav, acc_nav, growth):
+        self.rows.append((code, d, nav, acc_nav, growth))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def flush(self):
+        """每个月份写一个新文件, 文件落盘之后再在同一个事务里登记索引; 中途失败只会留下索引里没有的孤立文件"""
+
+        if not self.rows:
+            return
+
+        s_time = monotonic()
+        self.batches = self.batches + 1
+        batch = '{}-{}-{}'.format(strftime('%Y%m%d%H%M%S', localtime()), os.getpid(), self.batches)
+
+        months = defaultdict(list)
+        for row in self.rows:
+            months[row[1].strftime('%Y%m')].append(row)
+
+        files = []
+        segments = []
+
+        for month, rows in sorted(months.items()):
+
+            rows.sort(key=lambda r: (r[0], r[1]))
+
+            columns = list(zip(*rows))
+            table = pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, _schema())], schema=_schema())
+
+            rel = os.path.join('month=' + month, 'part-{}.arrow'.format(batch))
+            path = os.path.join(self.path, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with pa.OSFile(path + '.tmp', 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(path + '.tmp', path)
+
+            files.append((rel, min(r[1] for r in rows).isoformat(), max(r[1] for r in rows).isoformat(), len(rows)))
+
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i][0] != rows[start][0]:
+                    segments.append((rows[start][0], rel, start, i - start,
+                                     rows[start][1].isoformat(), rows[i - 1][1].isoformat()))
+                    start = i
+
+        last = {}
+        for code, _, _, _, _, seg_last in segments:
+            last[code] = max(last.get(code, seg_last), seg_last)
+
+        with self.conn:
+            self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', files)
+            self.conn.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)', segments)
+            self.conn.executemany('INSERT INTO latest VALUES (?, ?) ON CONFLICT(fcode) DO UPDATE SET last=MAX(last, excluded.last)',
+                                  last.items())
+
+        metrics.inc('rows_total', len(self.rows), table='nav', result='inserted')
+
+        logging.info('nav batch: rows:%d funds:%d files:%d cost %.2f seconds',
+                     len(self.rows), len(last), len(files), monotonic() - s_time)
+
+        self.rows.clear()
+
+    def _open(self, rel):
+        return pa.ipc.open_file(pa.memory_map(os.path.join(self.path, rel))).read_all()
+
+    def read_fund(self, code, start=None, end=None):
+        """一只基金 [start, end] 的净值, 只切出索引里记录的行区间"""
+
+        sql = 'SELECT path, offset, length FROM segments WHERE fcode=?'
+        params = [code]
+        if start is not None:
+            sql = sql + ' AND last>=?'
+            params.append(start.isoformat())
+        if end is not None:
+            sql = sql + ' AND first<=?'
+            params.append(end.isoformat())
+
+        parts = [self._open(rel).slice(offset, length) for rel, offset, length in self.conn.execute(sql + ' ORDER BY first', params)]
+
+        table = pa.concat_tables(parts) if parts else _schema().empty_table()
+
+        return self._between(table, start, end)
+
+    def read_date(self, d):
+        """某一天全部基金的净值, 只读日期范围覆盖这一天的文件"""
+
+        rels = [r for r, in self.conn.execute('SELECT path FROM files WHERE first<=? AND last>=?', (d.isoformat(), d.isoformat()))]
+
+        parts = [self._open(rel) for rel in rels]
+        parts = [t.filter(pc.equal(t['date'], pa.scalar(d, pa.date32()))) for t in parts]
+
+        return pa.concat_tables(parts) if parts else _schema().empty_table()
+
+    @staticmethod
+    def _between(table, start, end):
+
+        if start is not None:
+            table = table.filter(pc.greater_equal(table['date'], pa.scalar(start, pa.date32())))
+        if end is not None:
+            table = table.filter(pc.less_equal(table['date'], pa.scalar(end, pa.date32())))
+
+        return table
+
+
+def _fetch_group(codes, latest, today, store, concurrency, rps):
+    """取完 codes 每只基金上次存储日期之后的全部净值, 放进 store 但不写入; 返回基金数"""
+
+    # {code: 页号}, 一页全是新数据且接口还有更早的记录时继续取下一页
+    pages = {}
+    sizes = {}
+    fetched = defaultdict(int)
+
+    for code in codes:
+        since = latest.get(code)
+        # 接口按日期倒序分页; 有历史时一页取到上次日期之后的全部天数, 留出余量
+        sizes[code] = BACKFILL if since is None else (today - since).days + 5
+        pages[code] = 1
+
+    while pages:
+
+        more = {}
+
+        def jobs():
+            for code, page in pages.items():
+                yield code, nav_url.format(code, page, sizes[code])
+
+        def handle(code, j):
+
+            since = latest.get(code)
+            data = (j or {}).get('Datas') or []
+            total = (j or {}).get('TotalCount')
+
+            n = 0
+            for item in data:
+                d = parse_date(item.get('FSRQ'))
+                if d is None or (since is not None and d <= since):
+                    continue
+                store.add(code, d, _float(item.get('DWJZ')), _float(item.get('LJJZ')), _float(item.get('JZZZL')))
+                n = n + 1
+
+            fetched[code] = fetched[code] + len(data)
+
+            # 按 TotalCount 判断是否还有下一页, 不以短页当作末页: 接口可能把 pagesize 截小
+            left = fetched[code] < total if total is not None else len(data) >= sizes[code]
+
+            if data and n == len(data) and left:
+                if pages[code] == 1 and len(data) < sizes[code]:
+                    # 之后按接口实际的页大小翻页, 页号和条数才对得上
+                    sizes[code] = len(data)
+                more[code] = pages[code] + 1
+
+        fetch_all(client(), jobs(), handle, concurrency, rps)
+
+        pages = more
+
+    return len(codes)
+
+
+def do_nav(codes, concurrency=8, rps=10, store=None):
+    """codes 为要抓的基金代码; 每只基金只取上次存储日期之后的净值.
+
+    按 GROUP 只一组地抓取, 一组的基金全部取完才可能写入, 写入时才推进 latest;
+    中断后没写入的基金下次从原来的日期重新取, 不会因为先写了较新的一页而漏掉更早的历史.
+    """
+
+    if store is None:
+        store = NavStore()
+
+    latest = store.latest()
+    today = date.today()
+
+    codes = [code for code in codes if latest.get(code) is None or latest[code] < today]
+    funds = 0
+
+    for i in range(0, len(codes), GROUP):
+
+        funds = funds + _fetch_group(codes[i:i + GROUP], latest, today, store, concurrency, rps)
+
+        if len(store) >= 100000:
+            store.flush()
+
+    store.flush()
+
+    logging.info('nav over! funds:%d', funds)
+
+
+if __name__ == "__main__":
+
+    import detail
+    from logs import setup_logging
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=8, help='同时在途的请求数')
+    parser.add_argument('--rps', type=float, default=10, help='每秒最多请求数, 实际速率在此之内自适应调整')
+    args = parser.parse_args()
+
+    setup_logging('nav')
+
+    s_time = monotonic()
+
+    db_user = getpass.getuser()
+    db_passwd = getpass.getpass('数据库密码:')
+    db_host = os.environ.get('db_host')
+    db_name = 'fintech'
+
+    detail.db_init(db_user, db_passwd, db_host, db_name, lean=True)
+
+    do_nav(sorted(detail.db_fund_detail.keys()), args.concurrency, args.rps)
+
+    write_metrics('nav', monotonic() - s_time)
+
+    logging.info('nav cost {:.2f} seconds!'.format(monotonic() - s_time))
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from random import random
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+from requests import Request, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+
+from metrics import endpoint, metrics
+from schema import loads
+from state import load_state, save_state
+
+HEADERS = {'Content-Type': 'application/json; charset=utf-8',
+           'Accept-Encoding': 'gzip, deflate',
+           'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'}
+
+# (连接超时, 读超时), 没有超时的话一个卡住的连接会让整个抓取一直挂着
+TIMEOUT = (5, 30)
+
+# 新 host 的默认上限, 调用方可以用 configure 按 host 调整
+CONCURRENCY = 4
+RPS = 5
+MIN_RPS = 0.2
+
+# 响应时间超过历史最快的 SLOW 倍视为拥塞, 拥塞或出错时窗口和速率乘以 DECREASE
+SLOW = 4
+DECREASE = 0.7
+
+RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# 连续失败 FAILURES 次后熔断 COOLDOWN 秒, 之后放行一个探测请求; 连续 OUTAGE 次探测失败才放弃整个抓取
+FAILURES = 8
+COOLDOWN = 60
+OUTAGE = 10
+
+
+class CircuitOpen(Exception):
+    """host 长时间不可用, 抓取应当中止并保留断点"""
+
+
+class BadStatus(Exception):
+    """429/5xx, 可以重试"""
+
+    def __init__(self, r):
+        super().__init__('HTTP {}'.format(r.status_code))
+        self.status_code = r.status_code
+        try:
+            self.retry_after = float(r.headers.get('Retry-After', 0))
+        except ValueError:
+            self.retry_after = 0
+
+
+class HostController(object):
+    """每个 host 一个, 按响应时间和错误 AIMD 调整并发窗口和速率:
+    正常响应时窗口每个往返 +1、速率每秒 +1, 拥塞或出错时按 DECREASE 成倍下降, 不超过 configure 给的上限.
+    acquire/release 可在多个线程中调用."""
+
+    def __init__(self, host, concurrency=CONCURRENCY, rps=RPS):
+        self.host = host
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.next_slot = monotonic()
+        self.fastest = None
+        self.since_decrease = 0
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.probes = 0
+
+        self.requests = 0
+        self.errors = 0
+        self.decreases = 0
+
+        # 从上限的一半起步
+        self.window = max(1.0, concurrency / 2)
+        self.rps = max(MIN_RPS, rps / 2)
+
+        self.configure(concurrency, rps)
+
+    def configure(self, concurrency, rps):
+        with self.cond:
+            self.max_window = max(1, concurrency)
+            self.max_rps = max(MIN_RPS, rps)
+            self.window = min(self.window, self.max_window)
+            self.rps = min(self.rps, self.max_rps)
+            self.cond.notify_all()
+
+    def acquire(self):
+        """等到窗口有空位且轮到速率名额, 返回等待的秒数"""
+
+        t = monotonic()
+
+        with self.cond:
+            # 熔断期间等到冷却结束, 放行一个探测请求, 其余请求等探测的结果
+            while self.failures >= FAILURES:
+                if self.probes >= OUTAGE:
+                    raise CircuitOpen('{} is down, {} probes failed'.format(self.host, self.probes))
+                wait = self.open_until - monotonic()
+                if wait > 0 or self.probing:
+                    self.cond.wait(wait if wait > 0 else None)
+                    continue
+                self.probing = True
+                self.probes = self.probes + 1
+                break
+
+            while self.inflight >= int(self.window):
+                self.cond.wait()
+
+            self.inflight = self.inflight + 1
+
+            now = monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1.0 / self.rps
+
+        if slot > now:
+            sleep(slot - now)
+
+        return monotonic() - t
+
+    def release(self, latency, ok):
+
+        with self.cond:
+            self.inflight = self.inflight - 1
+            self.requests = self.requests + 1
+            self.probing = False
+
+            if ok:
+                self.failures = 0
+                self.probes = 0
+                self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+
+            if ok and latency <= self.fastest * SLOW:
+                self.window = min(self.max_window, self.window + 1.0 / self.window)
+                self.rps = min(self.max_rps, self.rps + 1.0 / self.rps)
+            # 下降后至少再收到一个窗口的响应才会再降, 同一批在途请求的慢响应/错误只算一次
+            elif self.since_decrease >= self.window:
+                self.window = max(1.0, self.window * DECREASE)
+                self.rps = max(MIN_RPS, self.rps * DECREASE)
+                self.since_decrease = 0
+                self.decreases = self.decreases + 1
+
+            self.since_decrease = self.since_decrease + 1
+
+            if not ok:
+                self.errors = self.errors + 1
+                self.failures = self.failures + 1
+                if self.failures >= FAILURES:
+                    self.open_until = monotonic() + COOLDOWN
+                    logging.warning('%s circuit open after %d failures', self.host, self.failures)
+
+            self.cond.notify_all()
+
+    def tripped(self):
+        return self.failures >= FAILURES
+
+    def report(self):
+        logging.info('%s requests:%d errors:%d decreases:%d window:%.1f rps:%.1f',
+                     self.host, self.requests, self.errors, self.decreases, self.window, self.rps)
+
+
+class PooledAdapter(HTTPAdapter):
+    """连接池大小按并发设置, 请求没有指定超时时使用 TIMEOUT"""
+
+    def __init__(self, pool_size):
+        super().__init__(pool_connections=10, pool_maxsize=pool_size)
+        self.pool_size = pool_size
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or TIMEOUT, **kwargs)
+
+    def stats(self):
+        """[(host, 请求数, 新建连接数)], 两者之差即复用 keep-alive 连接的请求数"""
+
+        pools = self.poolmanager.pools
+        return [(pools[k].host, pools[k].num_requests, pools[k].num_connections) for k in pools.keys()]
+
+
+_session = None
+
+
+def client():
+    """fund/detail/rate 共用的 Session"""
+
+    global _session
+
+    if _session is None:
+        _session = Session()
+        _session.headers.update(HEADERS)
+        _session.mount('https://', PooledAdapter(CONCURRENCY))
+        _session.mount('http://', PooledAdapter(CONCURRENCY))
+
+    return _session
+
+
+controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def controller(url, concurrency=CONCURRENCY, rps=RPS):
+    """url 所在 host 的控制器, 第一次用到时按给定的上限创建"""
+
+    host = urlparse(url).netloc
+
+    with _controllers_lock:
+        if host not in controllers:
+            controllers[host] = HostController(host, concurrency, rps)
+        return controllers[host]
+
+
+# pin 过的 host, configure 不再改动
+pinned = set()
+
+
+def configure(url, concurrency, rps, session=None):
+    """设置 url 所在 host 的并发和速率上限, 并为该 host 挂上同样大小的连接池; pin 过的 host 不变"""
+
+    if urlparse(url).netloc in pinned:
+        return
+
+    controller(url, concurrency, rps).configure(concurrency, rps)
+
+    session = session or client()
+
+    u = urlparse(url)
+    prefix = '{}://{}/'.format(u.scheme, u.netloc)
+
+    adapter = session.adapters.get(prefix)
+    if adapter is None or getattr(adapter, 'pool_size', 0) < concurrency:
+        session.mount(prefix, PooledAdapter(concurrency))
+
+
+def pin(url, concurrency, rps, session=None):
+    """几个线程共用一个 host 时, 在线程启动前按合计的上限配置一次并挂好连接池.
+    之后各线程里的 configure 对该 host 不起作用: 不会互相覆盖上限, 也不会在别的线程发请求时改动 session.adapters"""
+
+    configure(url, concurrency, rps, session)
+    pinned.add(urlparse(url).netloc)
+
+
+def report(session=None):
+
+    for c in controllers.values():
+        c.report()
+
+    session = session or client()
+
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, PooledAdapter):
+            for host, requests, connections in adapter.stats():
+                logging.info('%s pool:%d requests:%d connections:%d keep-alive reuse:%.1f%%',
+                             host, adapter.pool_size, requests, connections,
+                             100.0 * (requests - connections) / requests if requests else 0)
+
+
+def _json(r):
+
+    body = r.content
+
+    t = monotonic()
+    j = loads(body)
+
+    stage = endpoint(r.url)
+    metrics.inc('download_bytes_total', len(body), stage=stage)
+    metrics.inc('parse_seconds_total', monotonic() - t, stage=stage)
+
+    return body, j
+
+
+def send(session, prepped, parse=_json, **kwargs):
+    """经所在 host 的控制器发送请求, 连接错误/超时/429/5xx/解析失败时按带抖动的指数退避重试.
+    parse(r) 的返回值即结果, parse 为 None 时只检查状态码. 其余参数传给 session.send. 返回 (r, 结果)
+    熔断期间的失败不计入重试次数, host 一直不恢复时由 acquire 抛出 CircuitOpen"""
+
+    ctl = controller(prepped.url)
+    name = endpoint(prepped.url)
+    attempt = 0
+
+    while True:
+
+        metrics.inc('http_wait_seconds_total', ctl.acquire(), endpoint=name, reason='throttle')
+
+        s_time = monotonic()
+        ok = False
+        healthy = False
+        error = None
+
+        try:
+            r = session.send(prepped, **kwargs)
+
+            if r.status_code == 429 or r.status_code >= 500:
+                raise BadStatus(r)
+
+            # 304 由调用方处理, 其余 4xx 重试也没用; host 本身是好的, 不计入熔断
+            if r.status_code != 304 and r.status_code >= 400:
+                healthy = True
+                r.raise_for_status()
+
+            result = parse(r) if parse and r.status_code != 304 else None
+            ok = True
+        except (BadStatus, ConnectionError, Timeout, ValueError) as e:
+            error = e
+        finally:
+            latency = monotonic() - s_time
+            ctl.release(latency, ok or healthy)
+            metrics.observe('http_request_seconds', latency, endpoint=name, result='ok' if ok else 'error')
+
+        if ok:
+            return r, result
+
+        if ctl.tripped():
+            # 退避交给 acquire 里的冷却
+            continue
+
+        if attempt == RETRIES:
+            raise error
+
+        attempt = attempt + 1
+
+        delay = random() * min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1))
+        if isinstance(error, BadStatus):
+            delay = max(delay, error.retry_after)
+
+        logging.warning('%s %s: %s, retry %d in %.1f seconds', prepped.method, prepped.url, error, attempt, delay)
+        sleep(delay)
+
+        metrics.inc('http_retries_total', endpoint=name)
+        metrics.inc('http_wait_seconds_total', delay, endpoint=name, reason='backoff')
+
+
+# 重试之后仍然失败的单个请求(4xx、非 JSON、一直超时等), 记下跳过, 不中止整个抓取
+FAILED = (BadStatus, RequestException, ValueError)
+
+
+def _failed(url, error):
+
+    logging.warning('GET %s failed, skipped: %s', url, error)
+    metrics.inc('fetch_failed_total', endpoint=endpoint(url))
+
+
+def send_json(session, prepped, cache=None, ttl=0):
+    """发送请求并解析 JSON, 传入 cache 时先查 ttl 秒内的缓存. 返回 (json, 是否实际发出了请求);
+    重试后仍失败时 json 为 None, host 熔断不恢复时抛出 CircuitOpen"""
+
+    if cache is not None:
+        j = cache.get_json(prepped.url, ttl)
+        if j is not None:
+            return j, False
+
+    try:
+        r, (body, j) = send(session, prepped)
+    except FAILED as e:
+        _failed(prepped.url, e)
+        return None, True
+
+    if cache is not None:
+        cache.put(prepped.url, body)
+
+    return j, True
+
+
+async def _fetch_all(session, jobs, handle, concurrency, rps, cache, ttl):
+
+    loop = asyncio.get_event_loop()
+    sem = asyncio.Semaphore(concurrency)
+    tasks = []
+    errors = []
+    hosts = set()
+
+    def get(url):
+        return send(session, session.prepare_request(Request('GET', url)))[1]
+
+    async def fetch(pool, key, url):
+        try:
+            try:
+                body, j = await loop.run_in_executor(pool, get, url)
+            except FAILED as e:
+                _failed(url, e)
+                body, j = None, None
+            if cache is not None and body is not None:
+                cache.put(url, body)
+            handle(key, j)
+        except Exception as e:
+            errors.append(e)
+            raise
+        finally:
+            sem.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for key, url in jobs:
+            if cache is not None:
+                j = cache.get_json(url, ttl)
+                if j is not None:
+                    handle(key, j)
+                    continue
+
+            host = urlparse(url).netloc
+            if host not in hosts:
+                configure(url, concurrency, rps, session)
+                hosts.add(host)
+
+            await sem.acquire()
+            if errors:
+                sem.release()
+                break
+            tasks.append(asyncio.ensure_future(fetch(pool, key, url)))
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if errors:
+        raise errors[0]
+
+    logging.info('fetch over: %d requests', len(tasks))
+
+
+def fetch_all(session, jobs, handle, concurrency=8, rps=10, cache=None, ttl=0):
+    """并发抓取 jobs 中的 (key, url), 最多 concurrency 个请求同时在途, 每秒不超过 rps 个,
+    实际的并发和速率由 host 的控制器在上限内自适应调整.
+
+    handle(key, json) 在事件循环所在的调用线程中执行, 可以直接操作 ORM 对象和 db_session.
+    传入 cache 时先查 ttl 秒内的缓存, 命中的不发请求也不占限速名额.
+    单个请求重试后仍失败时记日志后调用 handle(key, None), 不影响其余请求;
+    handle 出错或 host 熔断不恢复(CircuitOpen)时不再发出新请求, 等在途请求结束后抛出第一个异常.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_fetch_all(session, jobs, handle, concurrency, rps, cache, ttl))
+    finally:
+        loop.close()
+
+
+async def _fetch_pages(fetch, handle, window, known_pages):
+
+    loop = asyncio.get_event_loop()
+    inflight = {}
+    next_page = 1
+    page = 1
+    # 没有上次的页数时从 1 页开始逐步放大窗口; 超过上次页数后只向前探测 1 页
+    ramp = window if known_pages else 1
+
+    with ThreadPoolExecutor(max_workers=window) as pool:
+        while True:
+            if known_pages and next_page > known_pages + 1:
+                limit = 1
+            else:
+                limit = ramp
+
+            while len(inflight) < limit:
+                inflight[next_page] = loop.run_in_executor(pool, fetch, next_page)
+                next_page = next_page + 1
+
+            rows = await inflight.pop(page)
+
+            if not rows:
+                break
+
+            handle(page, rows)
+
+            page = page + 1
+            ramp = min(ramp * 2, window)
+
+        # 末页之后已发出的请求结果直接丢弃
+        for f in inflight.values():
+            f.cancel()
+
+    return page - 1
+
+
+def fetch_pages(fetch, handle, window=4, known_pages=0):
+    """按页号顺序抓取直到第一个空页, 最多 window 页同时在途.
+
+    fetch(page) 在线程池中执行并返回该页的记录列表, 应经由 send 发出请求以便限速和重试;
+    handle(page, rows) 按页号顺序在调用线程中执行.
+    known_pages 为上次运行的总页数, 已知时一开始就发出整个窗口. 返回非空页的页数.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_fetch_pages(fetch, handle, window, known_pages))
+    finally:
+        loop.close()
+
+
+def conditional_get(session, url, **kwargs):
+    """带上上次保存的 ETag/Last-Modified 发起 GET, 服务端返回 304 时返回 None. 其余参数传给 session.get"""
+
+    validator = load_state('validators', {}).get(url, {})
+
+    headers = {}
+    if validator.get('etag'):
+        headers['If-None-Match'] = validator['etag']
+    if validator.get('last_modified'):
+        headers['If-Modified-Since'] = validator['last_modified']
+
+    prepped = session.prepare_request(Request('GET', url, headers=headers))
+    r, _ = send(session, prepped, None, **kwargs)
+
+    if r.status_code == 304:
+        logging.info('not modified: %s', url)
+        r.close()
+        return None
+
+    return r
+
+
+def save_validator(url, r):
+    """解析入库成功后再保存, 中途失败时下次仍会完整下载"""
+
+    validators = load_state('validators', {})
+    validators[url] = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+    save_state('validators', validators)
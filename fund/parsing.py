@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 把接口返回的字符串字段(费率/日期/金额/期限)解析成数值, 解析不了的返回 None
+
+import re
+from datetime import date
+
+_percent = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+_date = re.compile(r'(\d{4})[-/年](\d{1,2})[-/月](\d{1,2})')
+_money = re.compile(r'(\d+(?:\.\d+)?)\s*(亿|万)?元?')
+_period = re.compile(r'(\d+(?:\.\d+)?)\s*(年|个月|月|周|天|日)')
+
+_money_units = {None: 1, '万': 10000, '亿': 100000000}
+_period_days = {'年': 365, '个月': 30, '月': 30, '周': 7, '天': 1, '日': 1}
+
+INF = float('inf')
+
+
+def parse_percent(s):
+    """'1.50%' -> 0.015"""
+
+    if not s:
+        return None
+
+    m = _percent.search(s)
+
+    return float(m.group(1)) / 100 if m else None
+
+
+def parse_date(s):
+    """'2001-12-18' -> date(2001, 12, 18)"""
+
+    if not s:
+        return None
+
+    m = _date.search(s)
+
+    if not m:
+        return None
+
+    try:
+        return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    except ValueError:
+        return None
+
+
+def parse_amount(s):
+    """'1.5亿元' -> 150000000.0, '100' -> 100.0"""
+
+    if not s:
+        return None
+
+    m = _money.search(s.replace(',', ''))
+
+    return float(m.group(1)) * _money_units[m.group(2)] if m else None
+
+
+def _bounds(s, values):
+    """按比较词判断一个数值是下限还是上限, 两个数值时依次为下限和上限"""
+
+    if not values:
+        return None, None
+
+    if len(values) >= 2:
+        return values[0], values[1]
+
+    if re.search(r'小于|低于|不足|以下|以内|<|＜|≤', s) and not re.search(r'大于|高于|以上|超过|>|＞|≥', s):
+        return 0.0, values[0]
+
+    return values[0], INF
+
+
+def parse_money_range(s):
+    """'大于等于100万元，小于500万元' -> (1000000.0, 5000000.0), 左闭右开"""
+
+    if not s:
+        return None, None
+
+    values = [float(m.group(1)) * _money_units[m.group(2)] for m in _money.finditer(s.replace(',', ''))]
+
+    return _bounds(s, values)
+
+
+def parse_period(s):
+    """'大于等于7天，小于1年' -> (7.0, 365.0), 单位为天, 左闭右开"""
+
+    if not s:
+        return None, None
+
+    values = [float(m.group(1)) * _period_days[m.group(2)] for m in _period.finditer(s)]
+
+    return _bounds(s, values)
+
+
+def parse_fee(s):
+    """'1.50%' -> (0.015, None), '每笔1000元' -> (None, 1000.0)"""
+
+    if not s:
+        return None, None
+
+    rate = parse_percent(s)
+
+    if rate is not None:
+        return rate, None
+
+    if '元' in s:
+        return None, parse_amount(s)
+
+    return None, None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 在一个进程里同时跑 fund -> detail -> rate 三个阶段:
+# fund 阶段新发现的代码经有界队列直接流进详情阶段, 取到详情的代码再经有界队列流进费率阶段.
+# 队列满时上游阻塞等待, 内存里积压的代码不超过 --queue-size.
+
+import argparse
+import getpass
+import logging
+import os
+import queue
+import threading
+from itertools import chain
+from time import monotonic
+
+import detail
+import fund
+import rate
+import upsert
+from logs import setup_logging
+from metrics import write_metrics
+from models import Fund_Detail, Fund_Rate
+from net import pin, report
+
+QUEUE_SIZE = 1000
+
+# 并发抓详情时一次最多从队列里取出的代码数
+BATCH = 200
+
+
+class Feed(object):
+    """两个阶段之间的有界队列, None 表示上游已经结束"""
+
+    def __init__(self, size=QUEUE_SIZE):
+        self.q = queue.Queue(maxsize=size)
+        self.closed = False
+
+    def put(self, code):
+        self.q.put(code)
+
+    def close(self):
+        self.q.put(None)
+
+    def batches(self, limit=BATCH):
+        """先阻塞等一个代码, 再把队列里已有的(最多 limit 个)一起取出"""
+
+        while True:
+            code = self.q.get()
+            if code is None:
+                self.closed = True
+                return
+
+            batch = [code]
+            while len(batch) < limit:
+                try:
+                    code = self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if code is None:
+                    self.closed = True
+                    yield batch
+                    return
+                batch.append(code)
+
+            yield batch
+
+    def discard(self):
+        """下游出错后继续取空队列, 免得上游一直阻塞"""
+
+        while not self.closed:
+            if self.q.get() is None:
+                self.closed = True
+
+
+def backlog(codes, size=BATCH):
+    """库里已有、但下游还没有数据(或需要重新抓取)的代码, 在队列之前先处理"""
+
+    codes = sorted(codes)
+
+    for i in range(0, len(codes), size):
+        yield codes[i:i + size]
+
+
+def run(args):
+
+    from schedule import plan
+
+    errors = []
+
+    to_detail = Feed(args.queue_size)
+    to_rate = Feed(args.queue_size)
+
+    detail_refresh = plan(detail.db_session, Fund_Detail, 'detail', args.budget) if args.budget else set()
+    rate_refresh = plan(rate.db_session, Fund_Rate, 'rate', args.budget) if args.budget else set()
+
+    detail_backlog = {code for code in detail.db_funds.keys() if code not in detail.db_fund_detail.keys()} | detail_refresh
+    rate_backlog = {code for code in rate.db_fund_detail.keys() if code not in rate.db_fund_rate.keys()} | rate_refresh
+
+    logging.info('pipeline backlog: detail:%d rate:%d', len(detail_backlog), len(rate_backlog))
+
+    # 详情和费率是同一个 host, 控制器和连接池按 host 共用: 线程启动前按两个阶段合计的上限配置一次,
+    # 免得各阶段的 configure 互相覆盖上限, 或者在别的阶段发请求时改动 session 的 adapters
+    pin(fund.hb_url, args.window, args.hb_rps)
+    pin(detail.em_url, max(1, args.concurrency) + 1, args.rps + args.rate_rps)
+
+    def fund_stage():
+        fund.do_howbuy(args.window, args.hb_rps, to_detail.put)
+        fund.do_eastmoney_wap(to_detail.put)
+        fund.report_near_matches()
+
+    def detail_stage():
+        detail.do_em_dt_stream(chain(backlog(detail_backlog), to_detail.batches()), to_rate.put,
+                               args.concurrency, args.rps, detail_refresh)
+
+    def rate_stage():
+        rate.getRate_stream(chain(backlog(rate_backlog), to_rate.batches()), args.rate_rps, rate_refresh)
+
+    def stage(name, target, feed, out):
+        try:
+            target()
+        except Exception as e:
+            logging.exception('%s stage failed', name)
+            errors.append(e)
+        finally:
+            if feed is not None:
+                feed.discard()
+            if out is not None:
+                out.close()
+
+    threads = [threading.Thread(target=stage, name=name, args=(name, target, feed, out))
+               for name, target, feed, out in (('fund', fund_stage, None, to_detail),
+                                               ('detail', detail_stage, to_detail, to_rate),
+                                               ('rate', rate_stage, to_rate, None))]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--window', type=int, default=4, help='好买排行同时在途的页数')
+    parser.add_argument('--hb-rps', type=float, default=5, help='好买排行每秒最多请求数')
+    parser.add_argument('--concurrency', type=int, default=0, help='详情同时在途的请求数, 0 为逐个抓取')
+    parser.add_argument('--rps', type=float, default=10, help='详情每秒最多请求数')
+    parser.add_argument('--rate-rps', type=float, default=5, help='费率每秒最多请求数')
+    parser.add_argument('--budget', type=int, default=0, help='详情和费率各按陈旧程度和变化频率挑选最多这么多只已有基金重新抓取')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='阶段之间的队列长度, 满了上游等待')
+    parser.add_argument('--chunk-size', type=int, default=upsert.CHUNK_SIZE, help='每条 INSERT 语句的行数')
+    parser.add_argument('--lean', action='store_true', help='只载入主键索引, 不把整张表的对象放在内存里')
+    args = parser.parse_args(argv)
+
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+
+    from search import refresh_index
+    from service import notify_on_commit
+
+    setup_logging('pipeline')
+    notify_on_commit()
+
+    s_time = monotonic()
+
+    upsert.CHUNK_SIZE = args.chunk_size
+
+    db_user = getpass.getuser()
+    db_passwd = getpass.getpass('数据库密码:')
+    db_host = os.environ.get('db_host')
+    db_name = 'fintech'
+
+    # 每个阶段用各自模块的 db_session, 会话不跨线程共享
+    fund.db_init(db_user, db_passwd, db_host, db_name, args.lean)
+    detail.db_init(db_user, db_passwd, db_host, db_name, lean=True)
+    rate.db_init(db_user, db_passwd, db_host, db_name, lean=True)
+
+    run(args)
+
+    report()
+
+    refresh_index(fund.db_session)
+
+    fund.db_session.close()
+    detail.db_session.close()
+    rate.db_session.close()
+
+    write_metrics('pipeline', monotonic() - s_time)
+
+    logging.info('pipeline cost {:.2f} seconds!'.format(monotonic() - s_time))
+
+
+if __name__ == "__main__":
+    main()
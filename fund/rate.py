@@ -5,123 +5,56 @@ __author__ = 'lidc'
 
 # PYTHONUNBUFFERED=1
 
+import argparse
 import gc
 import getpass
 import logging
 import os
-import sys
-from collections import OrderedDict
-from random import random
-from time import localtime, monotonic, sleep, strftime
+from time import monotonic
 from urllib.parse import quote_plus
 
 import requests
-from detail import Fund_Detail
-from sqlalchemy import Boolean, Column, String, DateTime, text, create_engine
-from sqlalchemy.ext.declarative import declarative_base
+import upsert
+from cache import ResponseCache
+from digest import DigestTracker
+from logs import setup_logging
+from metrics import write_metrics
+from migrate import add_missing_columns
+from models import Base, Fund_Detail, Fund_Digest, Fund_Rate
+from net import CircuitOpen, client, configure, report, send_json
+from schema import Field, Repeat, Schema
+from snapshot import load_index
+from state import Checkpoint
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from upsert import BulkWriter
 
-s_time = monotonic()
-today = strftime('%Y%m%d', localtime())
-
-logdir = os.path.join(sys.path[0], 'log')
-
-if not os.path.exists(logdir):
-    os.mkdir(logdir)
-
-FORMAT = '[%(asctime)s %(levelname)s]<%(process)d> %(message)s'
-logfile = os.path.join(logdir, '{}_{}.log'.format(os.path.basename(__file__)[:-3], today))
-
-fh = logging.FileHandler(filename=logfile, encoding='UTF-8')
-logging.basicConfig(handlers=[logging.StreamHandler(), fh], format=FORMAT, level=logging.INFO)
-
-Base = declarative_base()
-
-class Fund_Rate(Base):
-
-    __tablename__ = 'fund_rate'
-
-    fcode = Column(String(8), primary_key=True, comment='基金代码')
-    sgzt = Column(String(4), comment='申购状态')
-    shzt = Column(String(4), comment='赎回状态')
-    dtzt = Column(Boolean, comment='定投状态')
-    minsg = Column(String(16), comment='申购起点')
-    mindt = Column(String(16), comment='定投起点')
-    maxsg = Column(String(16), comment='日累计申购限额')
-    minssg = Column(String(16), comment='首次购买')
-    minsbsg = Column(String(16), comment='追加购买')
-    ssbcfmdata = Column(String(4), comment='买入确认日')
-    rdmcfmdata = Column(String(4), comment='卖出确认日')
-    mgrexp = Column(String(8), comment='管理费率')
-    trustexp = Column(String(8), comment='托管费率')
-    salesexp = Column(String(8), comment='销售服务费率')
-
-    sg_money1 = Column(String(16), comment='申购金额1')
-    sg_rate1 = Column(String(8), comment='申购费率1')
-    sg_money2 = Column(String(32), comment='申购金额2')
-    sg_rate2 = Column(String(8), comment='申购费率2')
-    sg_money3 = Column(String(32), comment='申购金额3')
-    sg_rate3 = Column(String(8), comment='申购费率3')
-    sg_money4 = Column(String(32), comment='申购金额4')
-    sg_rate4 = Column(String(8), comment='申购费率4')
-    sg_money5 = Column(String(16), comment='申购金额5')
-    sg_rate5 = Column(String(8), comment='申购费率5')
-
-    sh_time1 = Column(String(512), comment='持有期限1')
-    sh_rate1 = Column(String(8), comment='赎回费率1')
-    sh_time2 = Column(String(512), comment='持有期限2')
-    sh_rate2 = Column(String(8), comment='赎回费率2')
-    sh_time3 = Column(String(128), comment='持有期限3')
-    sh_rate3 = Column(String(8), comment='赎回费率3')
-    sh_time4 = Column(String(64), comment='持有期限4')
-    sh_rate4 = Column(String(8), comment='赎回费率4')
-    sh_time5 = Column(String(32), comment='持有期限5')
-    sh_rate5 = Column(String(8), comment='赎回费率5')
-    sh_time6 = Column(String(32), comment='持有期限6')
-    sh_rate6 = Column(String(8), comment='赎回费率6')
-    sh_time7 = Column(String(16), comment='持有期限7')
-    sh_rate7 = Column(String(8), comment='赎回费率7')
-
-    update_time = Column(DateTime, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'), comment='更新时间')
-
-
-def __fund_rate(fund_rate, data):
-
-    dtzt = data.get("DTZT", '0')
-
-    data["dtzt"] = int(dtzt.strip()) if dtzt else 0
-
-    fund_rate.sgzt = data["SGZT"]
-    fund_rate.shzt = data["SHZT"]
-    fund_rate.dtzt = bool(data["dtzt"])
-    fund_rate.minsg = data["MINSG"]
-    fund_rate.mindt = data["MINDT"]
-    fund_rate.maxsg = data["MAXSG"]
-    fund_rate.minssg = data["MINSSG"]
-    fund_rate.minsbsg = data["MINSBSG"]
-    fund_rate.ssbcfmdata = data["SSBCFMDATA"]
-    fund_rate.rdmcfmdata = data["RDMCFMDATA"]
-    fund_rate.mgrexp = data["MGREXP"]
-    fund_rate.trustexp = data["TRUSTEXP"]
-    fund_rate.salesexp = data["SALESEXP"]
-
-    sg_prefix = 'sg'
-
-    sg_list = data[sg_prefix]
-
-    if sg_list is not None:
-        sg_dict = handler_param(sg_list, 'money', 'rate', sg_prefix, 5)
-        for k, v in sg_dict.items():
-            setattr(fund_rate, k, v)
-
-    sh_prefix = 'sh'
-
-    sh_list = data[sh_prefix]
-
-    if sh_list is not None:
-        sh_dict = handler_param(sh_list, 'time', 'rate', sh_prefix, 7)
-        for k, v in sh_dict.items():
-            setattr(fund_rate, k, v)
+
+def _flag(dtzt):
+    """DTZT 为 '0'/'1' 之类的字符串, 可能带空白或为空"""
+
+    return bool(int(dtzt.strip())) if dtzt else False
+
+
+# 费率接口 Datas 的字段; sg/sh 为申购/赎回费率表, 展开为 sg_money1, sg_rate1, ... 列, 不足的补 None
+RATE = Schema('rate', [
+    Field('sgzt', 'SGZT'),
+    Field('shzt', 'SHZT'),
+    Field('dtzt', 'DTZT', convert=_flag),
+    Field('minsg', 'MINSG'),
+    Field('mindt', 'MINDT'),
+    Field('maxsg', 'MAXSG'),
+    Field('minssg', 'MINSSG'),
+    Field('minsbsg', 'MINSBSG'),
+    Field('ssbcfmdata', 'SSBCFMDATA'),
+    Field('rdmcfmdata', 'RDMCFMDATA'),
+    Field('mgrexp', 'MGREXP'),
+    Field('trustexp', 'TRUSTEXP'),
+    Field('salesexp', 'SALESEXP'),
+], [
+    Repeat('sg', ('money', 'rate'), 5),
+    Repeat('sh', ('time', 'rate'), 7),
+])
 
 
 db_session = ''
@@ -129,120 +62,197 @@ db_fund_detail = {}
 db_fund_rate = {}
 
 
-def db_init(db_user, db_passwd, db_host, db_name):
+def db_init(db_user, db_passwd, db_host, db_name, lean=False, db_url=None):
     # engine = create_engine("mysql+mysqldb://{}:{}@{}:3306/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
-    engine = create_engine("mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
+    # db_url 不为空时直接使用, 例如 bench 用的本地库
+    engine = create_engine(db_url or "mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(db_user, quote_plus(db_passwd), db_host, db_name))
 
     Base.metadata.create_all(engine)
+    add_missing_columns(engine, Fund_Digest)
 
     Session = sessionmaker(bind=engine)
 
     global db_session
     db_session = Session()
 
-    fund_detail = db_session.query(Fund_Detail.fcode, Fund_Detail).all()
-    fund_rate = db_session.query(Fund_Rate.fcode, Fund_Rate).all()
-
     global db_fund_detail, db_fund_rate
 
-    db_fund_detail = dict(fund_detail)
-    db_fund_rate = dict(fund_rate)
+    if lean:
+        # 只载入主键和 update_time, 写库和抓取只用来判断某只基金是否已有
+        db_fund_detail = load_index(db_session, Fund_Detail.fcode, Fund_Detail.update_time)
+        db_fund_rate = load_index(db_session, Fund_Rate.fcode, Fund_Rate.update_time)
+    else:
+        fund_detail = db_session.query(Fund_Detail.fcode, Fund_Detail).all()
+        fund_rate = db_session.query(Fund_Rate.fcode, Fund_Rate).all()
+
+        # 写库统一走 BulkWriter, 载入的对象只作为内存快照
+        db_session.expunge_all()
+
+        db_fund_detail = dict(fund_detail)
+        db_fund_rate = dict(fund_rate)
 
     logging.info('fund_detail count:%d    fund_rate count:%d', len(db_fund_detail), len(db_fund_rate))
 
 
 url = 'https://fundmobapi.eastmoney.com/FundMApi/FundRateInfo.ashx?FCODE={}&deviceid=Wap&plat=Wap&product=EFund&version=2.0.0'
-headers = {'Content-Type': 'application/json; charset=utf-8',
-           'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'}
+# 可选的本地响应缓存, 由 --cache 开启
+cache = None
+cache_ttl = 6 * 3600
+
+
+def getRate(update, resume=False, rps=5, refresh=()):
+    """refresh 为需要重新抓取的已有基金, 由 schedule.plan 按陈旧程度挑选"""
 
-s = requests.Session()
-s.headers.update(headers)
+    checkpoint = Checkpoint('rate', sorted(db_fund_detail.keys()), update, refresh)
 
+    if resume:
+        update = checkpoint.resume()
+        refresh = checkpoint.refresh
 
-def getRate(update):
+    from history import History
 
-    items = []
+    configure(url, 1, rps)
+
+    writer = BulkWriter(db_session, Fund_Rate, db_fund_rate, history=History(db_session, 'rate'))
+    tracker = DigestTracker(db_session, 'rate')
+    decoder = RATE.compile()
     i = 0
 
-    for code in db_fund_detail.keys():
+    for code in checkpoint.remaining():
 
         i = i + 1
 
         req = requests.Request('GET', url.format(code))
-        prepped = s.prepare_request(req)
+        prepped = client().prepare_request(req)
 
         if code not in db_fund_rate.keys():
 
-            r = s.send(prepped)
-
             # if r.encoding == 'ISO-8859-1':
             #     r.encoding = None
-            j = r.json()
+            j, _ = send_json(client(), prepped, cache, cache_ttl)
 
-            data = j['Datas']
+            data = j.get('Datas') if j else None
 
-            if data:
+            if data and tracker.check(code, data, False):
 
-                fund_rate = Fund_Rate()
-                fund_rate.fcode = code
-
-                __fund_rate(fund_rate, data)
-
-                items.append(fund_rate)
-
-            sleep(random())
+                writer.add(decoder.row(data, fcode=code))
 
         else:
-            if update and data:
+            if update or code in refresh:
 
-                r = s.send(prepped)
-                j = r.json()
+                j, _ = send_json(client(), prepped, cache, cache_ttl)
 
-                data = j['Datas']
+                data = j.get('Datas') if j else None
 
-                if data:
+                if data and tracker.check(code, data, True):
 
-                    fund_rate = db_fund_rate[code]
+                    writer.add(decoder.row(data, fcode=code))
 
-                    __fund_rate(fund_rate, data)
-
-                sleep(random())
+        checkpoint.done(code)
 
         if i == 100:
-            db_session.add_all(items)
-            db_session.commit()
-            # db_session.rollback()
+            writer.flush()
+            tracker.flush()
+            checkpoint.commit()
 
-            items.clear()
             i = 0
 
             gc.collect()
 
-            logging.info('commit 1k')
+            logging.info('rate commit 100')
 
-    db_session.add_all(items)
-    db_session.commit()
+    writer.flush()
+    tracker.flush()
+    tracker.report()
+    decoder.report()
+    checkpoint.clear()
 
-    logging.info('rate upsert over!')
+    logging.info('rate upsert over! inserted:%d updated:%d unchanged:%d',
+                 writer.inserted, writer.updated, writer.unchanged)
 
 
-def handler_param(dataList, name1, name2, prefix, maxLen):
+def getRate_stream(batches, rps=5, refresh=(), tracker=None, history=None):
+    """pipeline 用: batches 陆续给出详情阶段取到的基金代码, 抓取库里还没有费率的和 refresh 中的.
+    tracker/history 为空时新建, 说明见 detail.do_em_dt_stream"""
 
-    list_len = len(dataList) if len(dataList) < maxLen else maxLen
+    if history is None:
+        from history import History
+        history = History(db_session, 'rate')
 
-    data_dict = OrderedDict()
+    configure(url, 1, rps)
 
-    for i in range(list_len):
-        data_name1 = prefix + '_' + name1 + str(i + 1)
-        data_name2 = prefix + '_' + name2 + str(i + 1)
+    writer = BulkWriter(db_session, Fund_Rate, db_fund_rate, history=history)
+    tracker = tracker or DigestTracker(db_session, 'rate')
+    decoder = RATE.compile()
+    seen = set()
+    i = 0
 
-        data_dict[data_name1] = dataList[i][name1]
-        data_dict[data_name2] = dataList[i][name2]
+    for batch in batches:
 
-    return data_dict
+        for code in batch:
 
+            if code in seen or (code in db_fund_rate.keys() and code not in refresh):
+                continue
 
-if __name__ == "__main__":
+            seen.add(code)
+            i = i + 1
+
+            prepped = client().prepare_request(requests.Request('GET', url.format(code)))
+
+            j, _ = send_json(client(), prepped, cache, cache_ttl)
+
+            data = j.get('Datas') if j else None
+
+            if data and tracker.check(code, data, code in db_fund_rate.keys()):
+
+                writer.add(decoder.row(data, fcode=code))
+
+            if i == 100:
+                writer.flush()
+                tracker.flush()
+
+                i = 0
+
+                gc.collect()
+
+                logging.info('rate commit 100')
+
+    writer.flush()
+    tracker.flush()
+    tracker.report()
+    decoder.report()
+
+    logging.info('rate upsert over! inserted:%d updated:%d unchanged:%d',
+                 writer.inserted, writer.updated, writer.unchanged)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--update', action='store_true', help='重新抓取已有的费率')
+    parser.add_argument('--budget', type=int, default=0, help='不加 --update 时, 按陈旧程度和变化频率挑选最多这么多只已有基金重新抓取')
+    parser.add_argument('--rps', type=float, default=5, help='每秒最多请求数, 实际速率在此之内自适应调整')
+    parser.add_argument('--chunk-size', type=int, default=upsert.CHUNK_SIZE, help='每条 INSERT 语句的行数')
+    parser.add_argument('--cache', action='store_true', help='使用本地响应缓存, 费率缓存 6 小时')
+    parser.add_argument('--resume', action='store_true', help='从上次中断的位置继续, 沿用上次的 --update')
+    parser.add_argument('--lean', action='store_true', help='只载入主键索引, 不把整张表的对象放在内存里')
+    parser.add_argument('--export', action='store_true', help='抓取结束后导出列式快照')
+    args = parser.parse_args(argv)
+
+    from schedule import plan
+    from service import notify_on_commit
+
+    setup_logging('rate')
+    notify_on_commit()
+
+    s_time = monotonic()
+
+    upsert.CHUNK_SIZE = args.chunk_size
+
+    global cache
+
+    if args.cache:
+        cache = ResponseCache()
 
     db_user = getpass.getuser()
     db_passwd = getpass.getpass('数据库密码:')
@@ -251,11 +261,35 @@ if __name__ == "__main__":
 
     logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-    db_init(db_user, db_passwd, db_host, db_name)
+    db_init(db_user, db_passwd, db_host, db_name, args.lean)
+
+    # 续跑时 refresh 取断点里保存的; 重新 plan 会因为已经刷新过的基金抓取时间变了而挑出另一批
+    if args.budget and not args.update and not (args.resume and Checkpoint.exists('rate')):
+        refresh = plan(db_session, Fund_Rate, 'rate', args.budget)
+    else:
+        refresh = ()
+
+    try:
+        getRate(args.update, args.resume, args.rps, refresh)
+    except CircuitOpen as e:
+        # 断点留着, host 恢复后 --resume 接着抓
+        logging.error('rate aborted, rerun with --resume: %s', e)
+        write_metrics('rate', monotonic() - s_time)
+        raise SystemExit(1)
 
-    # update= True
-    # getRate(update)
+    if args.export:
+        from export import export_table
+        export_table(db_session, Fund_Rate)
 
-    getRate(False)
+    report()
 
-    logging.info('detai cost {:.2f} seconds!'.format(monotonic() - s_time))
+    if cache:
+        cache.report()
+
+    write_metrics('rate', monotonic() - s_time)
+
+    logging.info('rate cost {:.2f} seconds!'.format(monotonic() - s_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 按陈旧程度和变化频率挑出今晚要重新抓取的已有基金, 代替 --update 的全量重抓
+
+import heapq
+import logging
+import math
+from datetime import datetime
+
+from models import Fund_Digest
+
+# 没有观察到变化时的先验: 每 PRIOR_DAYS 天变化一次
+PRIOR_DAYS = 180
+
+# 超过 MAX_AGE 天没有抓取过的基金无论变化频率如何都优先抓, 保证新鲜度有上界
+MAX_AGE = 30
+
+
+def change_rate(changes, observed_days):
+    """每天变化次数的估计, 观察时间短或没有变化时向先验收缩"""
+
+    return ((changes or 0) + 1) / (observed_days + PRIOR_DAYS)
+
+
+def priority(changes, observed_days, age_days):
+    """距上次抓取 age_days 天后已经变化的概率(按泊松过程), 超过 MAX_AGE 天的排在所有基金之前"""
+
+    p = 1 - math.exp(-change_rate(changes, observed_days) * age_days)
+
+    if age_days > MAX_AGE:
+        return 1 + age_days
+
+    return p
+
+
+def plan(session, model, kind, budget, now=None):
+    """model 为目标表(Fund_Detail/Fund_Rate), kind 为 'detail' 或 'rate'.
+    返回优先级最高的 budget 个已有基金代码的集合"""
+
+    now = now or datetime.now()
+
+    key = list(model.__table__.primary_key)[0]
+
+    q = session.query(key, model.update_time,
+                      getattr(Fund_Digest, kind + '_changes'),
+                      getattr(Fund_Digest, kind + '_checked'),
+                      Fund_Digest.create_time).outerjoin(Fund_Digest, Fund_Digest.fcode == key)
+
+    def days(t):
+        return (now - t).total_seconds() / 86400 if t else 0.0
+
+    def scored():
+        for code, update_time, changes, checked, created in q.execution_options(stream_results=True).yield_per(10000):
+            # 还没有记录抓取时间的, 用最后一次变化的时间
+            age = days(checked or update_time)
+            yield priority(changes, days(created or update_time), age), code
+
+    top = heapq.nlargest(budget, scored())
+
+    if top:
+        logging.info('%s schedule: %d funds, priority %.3f ~ %.3f', kind, len(top), top[0][0], top[-1][0])
+
+    return {code for _, code in top}
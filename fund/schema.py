@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 接口返回的 Datas 到表列的声明式映射. 每个接口的字段表编译一次, 之后每条记录:
+#
+#   一次 itemgetter 取出全部标量字段(C 实现, 不逐个 data[...])
+#   少数需要转换的字段按下标转换
+#   sg/sh 这样的列表展开成固定数目的列, 不足的补 None
+#
+# 得到与 columns 对齐的元组. 缺少声明的字段(missing)、相对第一条记录多出(new)或少了(gone)的键、类型变化(type)
+# 记为漂移, 记日志和指标, 不在运行中途抛 KeyError.
+
+import json
+import logging
+from collections import Counter
+from operator import itemgetter
+
+from metrics import metrics
+
+try:
+    import orjson
+except ImportError:  # 没有时退回标准库
+    orjson = None
+
+NoneType = type(None)
+
+
+def loads(body):
+    """bytes 或 str 解析为 JSON; 装了 orjson 时用它"""
+
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def _getter(names):
+    """itemgetter 只有一个名称时返回标量, 包成元组, 与多个名称时一样可以 extend"""
+
+    if len(names) == 1:
+        name = names[0]
+        return lambda item: (item[name],)
+
+    return itemgetter(*names)
+
+
+class Field(object):
+    """一个标量字段: key 为接口里的名称, column 为表的列名, convert 不为空时对取出的值做转换"""
+
+    def __init__(self, column, key, types=(str,), convert=None):
+        self.column = column
+        self.key = key
+        self.types = tuple(types) + (NoneType,)
+        self.convert = convert
+
+
+class Repeat(object):
+    """接口里的对象列表, 展开为 <prefix>_<name><序号> 列, 最多 count 组"""
+
+    def __init__(self, key, names, count, prefix=None):
+        self.key = key
+        self.names = names
+        self.count = count
+        self.prefix = prefix or key
+
+    @property
+    def columns(self):
+        return ['{}_{}{}'.format(self.prefix, name, i + 1) for i in range(self.count) for name in self.names]
+
+
+class Schema(object):
+
+    def __init__(self, name, fields, repeats=()):
+        self.name = name
+        self.fields = fields
+        self.repeats = repeats
+
+    def compile(self):
+        return Decoder(self)
+
+
+class Decoder(object):
+    """Schema 编译后的解码器, 每次运行用一个; 记录本次运行里见到的漂移"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = tuple([f.column for f in schema.fields] + [c for r in schema.repeats for c in r.columns])
+
+        self.keys = frozenset([f.key for f in schema.fields] + [r.key for r in schema.repeats])
+        self.getter = itemgetter(*[f.key for f in schema.fields])
+        self.converts = [(i, f.convert, f.types) for i, f in enumerate(schema.fields) if f.convert is not None]
+        self.repeats = [(r.key, _getter(r.names), len(r.names), r.count) for r in schema.repeats]
+
+        # 第一条记录的键作为基准, 接口返回的键比声明的多, 之后键的个数变了才逐个比较
+        self.baseline = None
+        self.width = -1
+
+        # 已经核对过的 (类型, ...) 组合, 同样的组合不再逐个字段检查
+        self.signatures = set()
+        self.drift = Counter()
+
+    def _drifted(self, kind, key, detail=''):
+
+        # 每个字段只在第一次出现时记日志
+        if (kind, key) not in self.drift:
+            logging.warning('%s schema drift: %s field %s %s', self.schema.name, kind, key, detail)
+
+        self.drift[(kind, key)] += 1
+        metrics.inc('schema_drift_total', endpoint=self.schema.name, kind=kind, field=key)
+
+    def _keys(self, data):
+
+        if self.baseline is None:
+            self.baseline = frozenset(data)
+            self.width = len(self.baseline)
+        else:
+            for key in self.baseline.symmetric_difference(data):
+                if key in data:
+                    self._drifted('new', key)
+                elif key not in self.keys:
+                    self._drifted('gone', key)
+
+        for key in self.keys.difference(data):
+            self._drifted('missing', key)
+
+    def _check(self, raw):
+
+        for f, value in zip(self.schema.fields, raw):
+            if not isinstance(value, f.types):
+                self._drifted('type', f.key, type(value).__name__)
+
+    def decode(self, data):
+        """Datas -> 与 columns 对齐的元组"""
+
+        if len(data) != self.width:
+            self._keys(data)
+
+        try:
+            raw = self.getter(data)
+        except KeyError:
+            # 键的个数没变却缺字段, 说明有字段改了名
+            if len(data) == self.width:
+                self._keys(data)
+            raw = tuple(data.get(f.key) for f in self.schema.fields)
+
+        signature = tuple(map(type, raw))
+        if signature not in self.signatures:
+            self._check(raw)
+            self.signatures.add(signature)
+
+        if self.converts:
+            raw = list(raw)
+            for i, convert, types in self.converts:
+                # 类型不对的值已由 _check 记为漂移, 不交给 convert, 取 None
+                raw[i] = convert(raw[i]) if isinstance(raw[i], types) else None
+
+        if not self.repeats:
+            return tuple(raw)
+
+        values = list(raw)
+
+        for key, getter, width, count in self.repeats:
+
+            items = data.get(key) or ()
+            n = 0
+
+            if not isinstance(items, (list, tuple)):
+                self._drifted('type', key, type(items).__name__)
+                items = ()
+
+            for item in items[:count]:
+                try:
+                    values.extend(getter(item))
+                except (KeyError, TypeError):
+                    self._drifted('missing', key + '[]')
+                    values.extend([None] * width)
+                n = n + 1
+
+            values.extend([None] * (width * (count - n)))
+
+        return tuple(values)
+
+    def row(self, data, **extra):
+        """供 BulkWriter.add 的行字典, extra 为接口里没有的列(例如主键)"""
+
+        extra.update(zip(self.columns, self.decode(data)))
+        return extra
+
+    def report(self):
+
+        if self.drift:
+            logging.info('%s schema drift: %s', self.schema.name,
+                         ', '.join('{} {}:{}'.format(kind, key, n) for (kind, key), n in sorted(self.drift.items())))
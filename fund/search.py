@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import argparse
+import getpass
+import json
+import logging
+import os
+import pickle
+import sys
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import inspect, text
+
+from logs import setup_logging
+from names import normalize
+
+indexfile = os.path.join(sys.path[0], 'cache', 'search.idx')
+
+# (表名, [代码列, 名称列...]), 两张表都有 ON UPDATE 的 update_time
+sources = (('fund', ('code', 'hb_name', 'em_name')),
+           ('fund_detail', ('fcode', 'shortname')))
+
+
+class CodeTrie(object):
+    """基金代码前缀树, 每个节点是 {字符: 子节点}, 键 None 存放以该节点结尾的代码"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, code):
+        node = self.root
+        for ch in code:
+            node = node.setdefault(ch, {})
+        node[None] = code
+
+    def prefix(self, prefix, limit=20):
+
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return []
+
+        result = []
+        stack = [node]
+
+        while stack and len(result) < limit:
+            node = stack.pop()
+            if None in node:
+                result.append(node[None])
+            stack.extend(node[k] for k in sorted((k for k in node if k is not None), reverse=True))
+
+        return result
+
+
+def _grams(s):
+    """单字和二元组, 一个字的查询也能命中"""
+
+    return set(s) | {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+class FundSearch(object):
+    """代码前缀树 + 名称(shortname/hb_name/em_name)的 n-gram 倒排索引"""
+
+    def __init__(self):
+        self.trie = CodeTrie()
+        self.postings = defaultdict(set)
+        self.names = {}
+        # 每张表已读到的最大 update_time, 刷新时只读之后变化的行
+        self.watermarks = {}
+
+    def set(self, code, column, name):
+        """更新某个代码的某一名称列, 旧名称的 n-gram 从倒排表中移除"""
+
+        if code not in self.names:
+            self.trie.add(code)
+            self.names[code] = {}
+
+        names = self.names[code]
+        before = set().union(*map(_grams, names.values()))
+
+        key = normalize(name)
+        if key:
+            names[column] = key
+        else:
+            names.pop(column, None)
+
+        after = set().union(*map(_grams, names.values()))
+
+        for g in before - after:
+            self.postings[g].discard(code)
+        for g in after - before:
+            self.postings[g].add(code)
+
+    def search(self, q, limit=20):
+        """纯数字按代码前缀查, 否则按名称片段查. 返回 [(code, {列名: 规范化后的名称})]"""
+
+        q = q.strip()
+
+        if q.isdigit():
+            codes = self.trie.prefix(q, limit)
+        else:
+            key = normalize(q)
+            grams = sorted(_grams(key), key=lambda g: len(self.postings.get(g, ())))
+            if not grams:
+                return []
+
+            # 从最短的倒排表开始求交集
+            candidates = set(self.postings.get(grams[0], ()))
+            for g in grams[1:]:
+                if not candidates:
+                    break
+                candidates &= self.postings.get(g, set())
+
+            codes = sorted(c for c in candidates if any(key in n for n in self.names[c].values()))[:limit]
+
+        return [(c, self.names[c]) for c in codes]
+
+    def refresh(self, session):
+        """读取上次刷新之后变化过的行, 第一次调用时读全表"""
+
+        s_time = monotonic()
+        count = 0
+
+        tables = set(inspect(session.get_bind()).get_table_names())
+
+        for table, cols in sources:
+
+            if table not in tables:
+                continue
+
+            sql = 'SELECT {}, update_time FROM {}'.format(', '.join(cols), table)
+
+            watermark = self.watermarks.get(table)
+            if watermark is not None:
+                sql = sql + ' WHERE update_time >= :watermark'
+
+            result = session.execute(text(sql).execution_options(stream_results=True), {'watermark': watermark})
+
+            for row in result:
+                for column, name in zip(cols[1:], row[1:-1]):
+                    self.set(row[0], column, name)
+                if row[-1] is not None and (watermark is None or row[-1] > watermark):
+                    watermark = row[-1]
+                count = count + 1
+
+            self.watermarks[table] = watermark
+
+        logging.info('search index refresh rows:%d codes:%d cost %.2f seconds', count, len(self.names), monotonic() - s_time)
+
+    def save(self, path=indexfile):
+        """只保存 names 和 watermarks 这样的内置类型, 不 pickle 类本身:
+        python search.py 里类的模块名是 __main__, 别的脚本读不回来"""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'names': self.names, 'watermarks': self.watermarks}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path=indexfile):
+        """读取保存的名称, 重建前缀树和倒排表; 文件不存在或读不了时返回空索引, 下次刷新读全表"""
+
+        index = FundSearch()
+
+        if not os.path.exists(path):
+            return index
+
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            names, watermarks = state['names'], state['watermarks']
+        except Exception:
+            logging.exception('search index %s unreadable, rebuilding', path)
+            return index
+
+        for code, columns in names.items():
+            index.trie.add(code)
+            index.names[code] = columns
+            for g in set().union(*map(_grams, columns.values())):
+                index.postings[g].add(code)
+
+        index.watermarks = watermarks
+
+        return index
+
+
+def refresh_index(session, path=indexfile):
+    """抓取结束后调用, 在已有索引文件的基础上增量刷新"""
+
+    index = FundSearch.load(path)
+    index.refresh(session)
+    index.save(path)
+
+    return index
+
+
+def serve(index, host='127.0.0.1', port=8766):
+    """GET /search?q=...&limit=20"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+
+            if url.path != '/search' or 'q' not in params:
+                self.send_error(404)
+                return
+
+            limit = int(params.get('limit', ['20'])[0])
+            result = [{'code': code, 'names': names} for code, names in index.search(params['q'][0], limit)]
+
+            body = json.dumps(result, ensure_ascii=False).encode('UTF-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info('search serving on %s:%d, %d codes', host, port, len(index.names))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--refresh', action='store_true', help='启动前从数据库增量刷新索引')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    setup_logging()
+
+    if args.refresh:
+        import fund
+
+        db_user = getpass.getuser()
+        db_passwd = getpass.getpass('数据库密码:')
+        db_host = os.environ.get('db_host')
+        db_name = 'fintech'
+
+        fund.db_init(db_user, db_passwd, db_host, db_name, lean=True)
+
+        index = refresh_index(fund.db_session)
+    else:
+        index = FundSearch.load()
+
+    serve(index, args.host, args.port)
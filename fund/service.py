@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 按基金代码查询 fund + fund_detail + fund_rate 的只读服务, 结果按代码缓存在内存里(LRU, 按字节数限制大小):
+#
+#   GET  /fund/<code>                 单只基金, 不存在时 404
+#   GET  /funds?codes=a,b,c           批量, 返回 {code: 对象或 null}
+#   POST /funds  ["a", "b", ...]      同上, 代码很多时用
+#   POST /invalidate {"codes": [...]} 加载脚本提交后调用, 只失效这些代码; {"all": true} 清空
+#   GET  /stats                       命中率、占用和读取耗时
+#
+# 未命中的代码合并成一次 IN 查询读库, 同一代码同时只读一次. 加载脚本设置了 FINTECH_CACHE_URL 时,
+# BulkWriter 每次提交后把写过的代码发到 /invalidate; 没收到通知的情况由 --ttl 兜底.
+# 读库可以指向只读从库(--db-url), 抓取时的写入不和查询抢主库.
+
+import argparse
+import asyncio
+import getpass
+import json
+import logging
+import os
+from collections import OrderedDict
+from time import monotonic
+from urllib.parse import parse_qs, quote_plus, unquote, urlparse
+from urllib.request import Request, urlopen
+
+from metrics import Histogram
+from models import Fund, Fund_Detail, Fund_Rate
+
+# 一次查询最多的代码数
+BATCH = 500
+
+# 秒; 亚毫秒级的读取需要比 metrics.BUCKETS 更细的桶
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# 这些表提交后需要失效缓存
+TABLES = {Fund.__tablename__, Fund_Detail.__tablename__, Fund_Rate.__tablename__}
+
+NOT_FOUND = b'null'
+
+
+class LRUCache(object):
+    """代码 -> 编码好的 JSON 字节串. 超过 max_bytes 时淘汰最久没用的, 超过 ttl 秒的视为未命中"""
+
+    def __init__(self, max_bytes=64 << 20, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, code):
+
+        item = self.items.get(code)
+
+        if item is None or (self.ttl and monotonic() - item[1] > self.ttl):
+            self.misses = self.misses + 1
+            return None
+
+        self.items.move_to_end(code)
+        self.hits = self.hits + 1
+
+        return item[0]
+
+    def put(self, code, body):
+
+        self.discard(code)
+
+        self.items[code] = (body, monotonic())
+        self.bytes = self.bytes + len(body)
+
+        while self.bytes > self.max_bytes and self.items:
+            _, (old, _) = self.items.popitem(last=False)
+            self.bytes = self.bytes - len(old)
+            self.evictions = self.evictions + 1
+
+    def discard(self, code):
+
+        item = self.items.pop(code, None)
+
+        if item is not None:
+            self.bytes = self.bytes - len(item[0])
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+
+class FundService(object):
+    """读穿缓存. 所有方法都在事件循环线程里调用, 读库放到线程池里"""
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+        self.loading = {}
+        # 读库期间被失效的代码, 读到的结果只返回给这次的调用方, 不进缓存
+        self.stale = set()
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    def _load(self, codes):
+        """在线程池里执行, 返回 {code: JSON 字节串}, 不存在的代码为 NOT_FOUND"""
+
+        result = {code: {} for code in codes}
+
+        with self.engine.connect() as conn:
+            for name, model in (('fund', Fund), ('detail', Fund_Detail), ('rate', Fund_Rate)):
+                table = model.__table__
+                key = list(table.primary_key)[0]
+                rows = conn.execute(table.select().where(key.in_(codes)))
+                names = list(rows.keys())
+                for r in rows:
+                    row = dict(zip(names, r))
+                    result[row[key.name]][name] = row
+
+        return {code: json.dumps(dict(code=code, fund=parts['fund'], detail=parts.get('detail'), rate=parts.get('rate')),
+                                 ensure_ascii=False, default=str).encode('UTF-8') if 'fund' in parts else NOT_FOUND
+                for code, parts in result.items()}
+
+    async def lookup(self, codes):
+        """{code: JSON 字节串}; 缓存里没有的合并读库, 已经在读的代码等同一次结果"""
+
+        loop = asyncio.get_event_loop()
+
+        found = {}
+        missing = []
+        waiting = {}
+
+        for code in dict.fromkeys(codes):
+            body = self.cache.get(code)
+            if body is not None:
+                found[code] = body
+            elif code in self.loading:
+                waiting[code] = self.loading[code]
+            else:
+                missing.append(code)
+
+        for i in range(0, len(missing), BATCH):
+            batch = missing[i:i + BATCH]
+            future = loop.run_in_executor(None, self._load, batch)
+            future.add_done_callback(lambda f, batch=batch: self._loaded(batch, f))
+            for code in batch:
+                self.loading[code] = future
+                waiting[code] = future
+
+        for code, future in waiting.items():
+            found[code] = (await future)[code]
+
+        return found
+
+    def _loaded(self, batch, future):
+        """一批读库结束(成功或失败)时调用: 整批移出 loading, 成功的进缓存.
+        失败只抛给正在等这一批的调用方, 之后的请求重新读库"""
+
+        ok = not future.cancelled() and future.exception() is None
+
+        for code in batch:
+            if self.loading.get(code) is not future:
+                continue
+            del self.loading[code]
+            if code in self.stale:
+                self.stale.discard(code)
+            elif ok:
+                self.cache.put(code, future.result()[code])
+
+    def invalidate(self, codes):
+
+        for code in codes:
+            self.cache.discard(code)
+            if code in self.loading:
+                self.stale.add(code)
+
+    def stats(self):
+        cache = self.cache
+        total = cache.hits + cache.misses
+        return {'items': len(cache.items), 'bytes': cache.bytes, 'max_bytes': cache.max_bytes,
+                'hits': cache.hits, 'misses': cache.misses, 'evictions': cache.evictions,
+                'hit_rate': cache.hits / total if total else 0.0,
+                'requests': self.latency.count, 'p50': self.latency.quantile(0.5), 'p99': self.latency.quantile(0.99)}
+
+
+async def _handle(service, reader, writer):
+    """最小的 HTTP/1.1: 支持 keep-alive 和带 Content-Length 的请求体"""
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h in (b'\r\n', b'\n', b''):
+                    break
+                k, _, v = h.decode('latin-1').partition(':')
+                headers[k.strip().lower()] = v.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+
+            t = monotonic()
+            try:
+                status, payload = await _route(service, method, target, body)
+            except Exception:
+                logging.exception('%s %s failed', method, target)
+                status, payload = '500 Internal Server Error', b'{}'
+            service.latency.observe(monotonic() - t)
+
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {}\r\n{}\r\n'.format(
+                status, len(payload), '' if keep_alive else 'Connection: close\r\n').encode('latin-1') + payload)
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _route(service, method, target, body):
+
+    url = urlparse(target)
+
+    if method == 'GET' and url.path.startswith('/fund/'):
+        code = unquote(url.path[len('/fund/'):])
+        payload = (await service.lookup([code]))[code]
+        return ('404 Not Found', payload) if payload is NOT_FOUND else ('200 OK', payload)
+
+    if url.path == '/funds' and method in ('GET', 'POST'):
+        if method == 'GET':
+            codes = [c for c in parse_qs(url.query).get('codes', [''])[0].split(',') if c]
+        else:
+            codes = json.loads(body or b'[]')
+        found = await service.lookup(codes)
+        # 缓存的是编码好的字节串, 直接拼接, 不再逐个解码
+        return '200 OK', b'{' + b','.join(json.dumps(c).encode('UTF-8') + b':' + found[c] for c in dict.fromkeys(codes)) + b'}'
+
+    if method == 'POST' and url.path == '/invalidate':
+        request = json.loads(body or b'{}')
+        if request.get('all'):
+            service.cache.clear()
+            service.stale.update(service.loading.keys())
+        else:
+            service.invalidate(request.get('codes', []))
+        return '200 OK', b'{}'
+
+    if method == 'GET' and url.path == '/stats':
+        return '200 OK', json.dumps(service.stats()).encode('UTF-8')
+
+    return '404 Not Found', b'{}'
+
+
+def serve(engine, host='127.0.0.1', port=8767, max_bytes=64 << 20, ttl=3600):
+
+    service = FundService(engine, LRUCache(max_bytes, ttl))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = loop.run_until_complete(asyncio.start_server(lambda r, w: _handle(service, r, w), host, port))
+    logging.info('fund service on %s:%d, cache %d MB', host, port, max_bytes >> 20)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
+
+
+class Invalidator(object):
+    """BulkWriter 提交后的回调, 把写过的代码发给服务. 服务不在时只记日志, 不影响抓取"""
+
+    def __init__(self, url, timeout=2):
+        self.url = url.rstrip('/') + '/invalidate'
+        self.timeout = timeout
+
+    def __call__(self, table, codes):
+
+        if table not in TABLES or not codes:
+            return
+
+        req = Request(self.url, data=json.dumps({'codes': list(codes)}).encode('UTF-8'),
+                      headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            urlopen(req, timeout=self.timeout).close()
+        except OSError as e:
+            logging.warning('invalidate %d codes failed: %s', len(codes), e)
+
+
+def notify_on_commit(url=None):
+    """加载脚本启动时调用; url 缺省取环境变量 FINTECH_CACHE_URL, 都没有时不通知"""
+
+    import upsert
+
+    url = url or os.environ.get('FINTECH_CACHE_URL')
+
+    if url:
+        upsert.on_commit.append(Invalidator(url))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--cache-mb', type=int, default=64, help='缓存占用上限(MB), 超过时淘汰最久没用的')
+    parser.add_argument('--ttl', type=int, default=3600, help='缓存最长保留秒数, 兜底没收到的失效通知; 0 为不过期')
+    parser.add_argument('--db-url', help='读库的 URL, 可以指向只读从库; 缺省询问密码连主库')
+    args = parser.parse_args(argv)
+
+    from sqlalchemy import create_engine
+
+    from logs import setup_logging
+
+    setup_logging('service')
+
+    db_url = args.db_url or "mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(
+        getpass.getuser(), quote_plus(getpass.getpass('数据库密码:')), os.environ.get('db_host'), 'fintech')
+
+    serve(create_engine(db_url, pool_size=8), args.host, args.port, args.cache_mb << 20, args.ttl)
+
+
+if __name__ == "__main__":
+    main()
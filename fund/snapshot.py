@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 只载入主键和少量列的紧凑快照, 代替把整张表的 ORM 对象常驻内存
+
+YIELD_PER = 10000
+
+
+def load_index(session, key, *cols):
+    """用服务端游标逐批读取 key 和 cols, 返回 {key: col} 或 {key: (col, ...)}, 不实例化 ORM 对象"""
+
+    q = session.query(key, *cols).execution_options(stream_results=True).yield_per(YIELD_PER)
+
+    if len(cols) == 1:
+        return {r[0]: r[1] for r in q}
+
+    return {r[0]: tuple(r[1:]) for r in q}
+
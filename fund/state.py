@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import json
+import logging
+import os
+import sys
+from bisect import bisect_right
+
+statedir = os.path.join(sys.path[0], 'state')
+
+
+def load_state(name, default=None):
+    """读取上次运行保存的状态, 不存在时返回 default"""
+
+    path = os.path.join(statedir, name + '.json')
+
+    if not os.path.exists(path):
+        return default
+
+    with open(path, encoding='UTF-8') as f:
+        return json.load(f)
+
+
+def save_state(name, value):
+    """先写临时文件再替换, 中途崩溃不会留下半个文件"""
+
+    if not os.path.exists(statedir):
+        os.mkdir(statedir)
+
+    path = os.path.join(statedir, name + '.json')
+    tmp = path + '.tmp'
+
+    with open(tmp, 'w', encoding='UTF-8') as f:
+        json.dump(value, f, ensure_ascii=False)
+
+    os.replace(tmp, path)
+
+
+def clear_state(name):
+
+    path = os.path.join(statedir, name + '.json')
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class Checkpoint(object):
+    """按代码顺序记录已经提交的位置, 供 --resume 从断点继续.
+
+    codes 必须是有序的; 每个处理完的代码调用 done, 每次提交后调用 commit.
+    并发模式下完成顺序是乱的, 只有前面的代码全部提交之后断点才会向后移动.
+    refresh 为本次要重新抓取的已有基金, 和 update 一起存进断点, 续跑时沿用.
+    """
+
+    def __init__(self, name, codes, update, refresh=()):
+        self.name = name + '_checkpoint'
+        self.codes = codes
+        self.update = update
+        self.refresh = set(refresh)
+        self.pos = 0
+        self.batch = 0
+        self.finished = set()
+
+    @staticmethod
+    def exists(name):
+        return load_state(name + '_checkpoint') is not None
+
+    def resume(self):
+        """从上次的断点继续, 返回上次运行的 update 参数, refresh 也换成上次的, 保证续跑的结果与一次跑完相同"""
+
+        state = load_state(self.name)
+
+        if state is None:
+            logging.info('%s not found, start from the beginning', self.name)
+            return self.update
+
+        self.batch = state['batch']
+        self.update = state['update']
+        self.refresh = set(state.get('refresh', ()))
+
+        if state['last_code'] is not None:
+            self.pos = bisect_right(self.codes, state['last_code'])
+
+        logging.info('resume from %s batch:%d update:%s', state['last_code'], self.batch, self.update)
+
+        return self.update
+
+    def remaining(self):
+        return self.codes[self.pos:]
+
+    def done(self, code):
+        self.finished.add(code)
+
+    def commit(self):
+
+        while self.pos < len(self.codes) and self.codes[self.pos] in self.finished:
+            self.finished.discard(self.codes[self.pos])
+            self.pos = self.pos + 1
+
+        self.batch = self.batch + 1
+
+        save_state(self.name, {'last_code': self.codes[self.pos - 1] if self.pos else None,
+                               'batch': self.batch,
+                               'update': self.update,
+                               'refresh': sorted(self.refresh)})
+
+    def clear(self):
+        clear_state(self.name)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+import logging
+from collections import OrderedDict
+
+from sqlalchemy.dialects.mysql import insert
+
+from metrics import metrics
+
+# 每条 INSERT 语句最多包含的行数, 入口脚本可通过 --chunk-size 修改
+CHUNK_SIZE = 500
+
+# 每批提交之后依次调用 f(表名, 主键列表), 例如 service.Invalidator
+on_commit = []
+
+
+class BulkWriter(object):
+    """把一批行字典写成多行 INSERT ... ON DUPLICATE KEY UPDATE, 不经过 ORM 的脏检查.
+
+    只更新行字典里出现的列, 列集合不同的行分到不同的语句里.
+    known 为库里已有的主键集合(或 dict), add 时据此区分新增和更新;
+    history 不为空时, 写库前先由它记下各行相对库里旧行变化的列, 与数据行一起提交;
+    mysqldb 连接默认带 CLIENT_FOUND_ROWS, 每行的影响行数为 新增 1, 有变化 2, 无变化 1.
+    """
+
+    def __init__(self, session, model, known=(), chunk_size=None, history=None):
+        self.session = session
+        self.table = model.__table__
+        self.key = list(self.table.primary_key)[0].name
+        self.known = known
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.history = history
+
+        self.rows = []
+        self.new = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row):
+        if row[self.key] not in self.known:
+            self.new = self.new + 1
+        self.rows.append(row)
+
+    def flush(self):
+
+        if not self.rows:
+            return 0, 0, 0
+
+        groups = OrderedDict()
+        for row in self.rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+
+        affected = 0
+
+        if self.history is not None:
+            with metrics.timer('db_flush_seconds', table='fund_history'):
+                self.history.record(self.table, self.rows)
+
+        with metrics.timer('db_flush_seconds', table=self.table.name):
+            for cols, rows in groups.items():
+                for i in range(0, len(rows), self.chunk_size):
+                    stmt = insert(self.table).values(rows[i:i + self.chunk_size])
+                    stmt = stmt.on_duplicate_key_update(OrderedDict((c, stmt.inserted[c]) for c in cols if c != self.key))
+                    affected = affected + self.session.execute(stmt).rowcount
+
+        with metrics.timer('db_commit_seconds', table=self.table.name):
+            self.session.commit()
+
+        if on_commit:
+            keys = [row[self.key] for row in self.rows]
+            for f in on_commit:
+                f(self.table.name, keys)
+
+        inserted = self.new
+        updated = affected - len(self.rows)
+        unchanged = len(self.rows) - inserted - updated
+
+        self.inserted = self.inserted + inserted
+        self.updated = self.updated + updated
+        self.unchanged = self.unchanged + unchanged
+
+        metrics.inc('rows_total', inserted, table=self.table.name, result='inserted')
+        metrics.inc('rows_total', updated, table=self.table.name, result='updated')
+        metrics.inc('rows_total', unchanged, table=self.table.name, result='unchanged')
+
+        logging.info('%s batch: inserted:%d updated:%d unchanged:%d',
+                     self.table.name, inserted, updated, unchanged)
+
+        self.rows.clear()
+        self.new = 0
+
+        return inserted, updated, unchanged
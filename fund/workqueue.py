@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = 'lidc'
+
+# 多个 worker 分片抓取详情/费率. 分片存在数据库的 crawl_shard 表里, 各主机上的 worker 共用:
+#
+#   python workqueue.py enqueue --kind detail          把要抓的代码切成分片入队
+#   python workqueue.py work --kind detail             领取分片、抓取、写库, 直到没有可领的分片
+#   python workqueue.py status --kind detail           各状态的分片数
+#
+# worker 领取分片时拿到一个租约, 抓取期间后台线程定期续约; worker 崩溃后租约到期, 分片被其他 worker 重新领取.
+# 租约时间一律用数据库的 NOW(), 不依赖各主机的时钟. 写库是按主键 upsert, 分片被重复抓取不影响结果.
+
+import argparse
+import getpass
+import logging
+import os
+import socket
+import threading
+import uuid
+from time import localtime, monotonic, sleep, strftime
+from urllib.parse import quote_plus
+
+from sqlalchemy import create_engine, text
+
+from models import Base, Crawl_Shard
+
+SHARD_SIZE = 500
+
+# 秒; 续约间隔为租约的 1/3, 连续两次续约失败之前租约不会过期
+LEASE = 120
+
+# 同一分片最多领取的次数, 超过后标为 failed, 不再重试
+MAX_ATTEMPTS = 3
+
+# 没有可领的分片但还有别人持有的分片时, 隔多久再看一次
+IDLE = 10
+
+
+class LeaseLost(Exception):
+    """租约已过期并被别的 worker 领走"""
+
+
+class WorkQueue(object):
+    """crawl_shard 表上的领取/续约/完成. engine 可在多个线程里共用, 每个操作用一个短事务"""
+
+    def __init__(self, engine, kind):
+        self.engine = engine
+        self.kind = kind
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())[:64]
+
+    def pending(self):
+        """还没完成的分片数"""
+
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT COUNT(*) FROM crawl_shard WHERE kind=:kind AND status IN ('pending', 'leased')"),
+                                {'kind': self.kind}).scalar()
+
+    def enqueue(self, codes, shard_size=SHARD_SIZE):
+        """codes 排序后按 shard_size 切片入队, 返回批次号. 上一批还没做完时不再入队"""
+
+        if self.pending():
+            raise RuntimeError('{} queue still has unfinished shards, run status or wait for workers'.format(self.kind))
+
+        codes = sorted(codes)
+        run = strftime('%Y%m%d%H%M%S', localtime())
+
+        rows = [{'kind': self.kind, 'run': run, 'shard': n, 'codes': ','.join(codes[i:i + shard_size]),
+                 'status': 'pending', 'attempts': 0}
+                for n, i in enumerate(range(0, len(codes), shard_size))]
+
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(Crawl_Shard.__table__.insert(), rows)
+
+        logging.info('%s run %s: %d codes in %d shards', self.kind, run, len(codes), len(rows))
+
+        return run
+
+    def claim(self, lease=LEASE):
+        """领取一个待处理或租约已过期的分片, 返回 (token, codes); 没有可领的返回 None.
+        UPDATE ... LIMIT 1 在一条语句里完成, 多个 worker 同时领取不会拿到同一个分片"""
+
+        token = uuid.uuid4().hex
+
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE crawl_shard SET status='failed', token=NULL "
+                              "WHERE kind=:kind AND status='leased' AND lease_until<NOW() AND attempts>=:max"),
+                         {'kind': self.kind, 'max': MAX_ATTEMPTS})
+
+            claimed = conn.execute(text("UPDATE crawl_shard SET status='leased', owner=:owner, token=:token, "
+                                        "attempts=attempts+1, lease_until=DATE_ADD(NOW(), INTERVAL :lease SECOND) "
+                                        "WHERE kind=:kind AND (status='pending' OR (status='leased' AND lease_until<NOW())) "
+                                        "ORDER BY id LIMIT 1"),
+                                   {'owner': self.owner, 'token': token, 'lease': lease, 'kind': self.kind}).rowcount
+
+            if not claimed:
+                return None
+
+            shard, run, codes, attempts = conn.execute(text('SELECT shard, run, codes, attempts FROM crawl_shard WHERE token=:token'),
+                                                       {'token': token}).first()
+
+        logging.info('%s run %s shard %d claimed, attempt %d', self.kind, run, shard, attempts)
+
+        return token, codes.split(',') if codes else []
+
+    def heartbeat(self, token, lease=LEASE):
+
+        with self.engine.begin() as conn:
+            renewed = conn.execute(text("UPDATE crawl_shard SET lease_until=DATE_ADD(NOW(), INTERVAL :lease SECOND) "
+                                        "WHERE token=:token AND status='leased'"),
+                                   {'lease': lease, 'token': token}).rowcount
+
+        if not renewed:
+            raise LeaseLost(token)
+
+    def done(self, token):
+        """返回 False 表示租约已经丢了, 分片由新的持有者负责"""
+
+        with self.engine.begin() as conn:
+            return bool(conn.execute(text("UPDATE crawl_shard SET status='done', token=NULL, done_time=NOW() "
+                                          "WHERE token=:token AND status='leased'"),
+                                     {'token': token}).rowcount)
+
+    def release(self, token):
+        """出错时立即交还分片, 不必等租约过期; 已到重试上限的标为 failed"""
+
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE crawl_shard SET status=IF(attempts>=:max, 'failed', 'pending'), token=NULL, lease_until=NULL "
+                              "WHERE token=:token AND status='leased'"),
+                         {'max': MAX_ATTEMPTS, 'token': token})
+
+    def status(self):
+        """{状态: (分片数, 最近一批的批次号)}"""
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('SELECT status, COUNT(*), MAX(run) FROM crawl_shard WHERE kind=:kind GROUP BY status'),
+                                {'kind': self.kind})
+            return {status: (n, run) for status, n, run in rows}
+
+
+class Lease(object):
+    """持有分片期间在后台线程里定期续约; 续约失败时 lost 置位, 分片完成时不再标记 done"""
+
+    def __init__(self, queue, token, lease=LEASE):
+        self.queue = queue
+        self.token = token
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lease-' + token[:8], daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                self.queue.heartbeat(self.token, self.lease)
+            except LeaseLost:
+                logging.warning('lease %s lost', self.token)
+                self.lost = True
+                return
+            except Exception:
+                # 数据库短暂不可用时下次再续, 租约还有 2/3 的余量
+                logging.exception('heartbeat %s failed', self.token)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def work(queue, crawl, lease=LEASE):
+    """领取并处理分片, 直到没有待处理的分片. crawl(codes) 返回之前必须已经提交写入"""
+
+    shards = 0
+
+    while True:
+
+        claimed = queue.claim(lease)
+
+        if claimed is None:
+            if queue.pending():
+                # 剩下的分片在别的 worker 手里, 它们崩溃后租约到期还要有人接手
+                sleep(IDLE)
+                continue
+            break
+
+        token, codes = claimed
+
+        with Lease(queue, token, lease) as held:
+            try:
+                crawl(codes)
+            except Exception:
+                queue.release(token)
+                raise
+
+        if held.lost or not queue.done(token):
+            logging.warning('%s shard finished after its lease expired, left to the new owner', queue.kind)
+        else:
+            shards = shards + 1
+
+    logging.info('%s worker over! shards:%d', queue.kind, shards)
+
+    return shards
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['enqueue', 'work', 'status'])
+    parser.add_argument('--kind', default='detail', choices=['detail', 'rate'])
+    parser.add_argument('--update', action='store_true', help='enqueue: 把已有的基金也全部入队')
+    parser.add_argument('--budget', type=int, default=0, help='enqueue: 不加 --update 时, 按陈旧程度再挑这么多只已有基金入队')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='enqueue: 每个分片的代码数')
+    parser.add_argument('--concurrency', type=int, default=0, help='work: 详情同时在途的请求数, 0 为逐个抓取')
+    parser.add_argument('--rps', type=float, default=0, help='work: 本 worker 每秒最多请求数, 缺省详情 10 费率 5')
+    parser.add_argument('--lease', type=int, default=LEASE, help='租约秒数')
+    parser.add_argument('--db-url', help='直接给出数据库 URL, 不再询问密码; 多主机无人值守时使用')
+    args = parser.parse_args(argv)
+
+    from logs import setup_logging
+    from metrics import write_metrics
+    from service import notify_on_commit
+
+    setup_logging('workqueue_' + args.kind)
+    notify_on_commit()
+
+    s_time = monotonic()
+
+    if args.db_url:
+        db_url = args.db_url
+    else:
+        db_url = "mysql+mysqldb://{}:{}@{}:21852/{}?charset=utf8mb4&binary_prefix=true".format(
+            getpass.getuser(), quote_plus(getpass.getpass('数据库密码:')), os.environ.get('db_host'), 'fintech')
+
+    if args.action == 'status':
+        engine = create_engine(db_url)
+        Base.metadata.create_all(engine, tables=[Crawl_Shard.__table__])
+        for status, (n, run) in sorted(WorkQueue(engine, args.kind).status().items()):
+            logging.info('%s %s: %d shards, latest run %s', args.kind, status, n, run)
+        return
+
+    # 加载函数所在的模块只在真正抓取或入队时导入
+    if args.kind == 'detail':
+        import detail as loader
+        from models import Fund_Detail as model
+    else:
+        import rate as loader
+        from models import Fund_Rate as model
+
+    loader.db_init(None, None, None, None, lean=True, db_url=db_url)
+
+    queue = WorkQueue(loader.db_session.get_bind(), args.kind)
+
+    if args.action == 'enqueue':
+        from schedule import plan
+
+        if args.kind == 'detail':
+            known, done = loader.db_funds, loader.db_fund_detail
+        else:
+            known, done = loader.db_fund_detail, loader.db_fund_rate
+
+        codes = {code for code in known.keys() if args.update or code not in done.keys()}
+
+        if args.budget and not args.update:
+            codes |= plan(loader.db_session, model, args.kind, args.budget)
+
+        queue.enqueue(codes, args.shard_size)
+
+        return
+
+    from digest import DigestTracker
+    from history import History
+
+    # fund_digest 和 fund_history 的索引每个 worker 只载入一次, 各分片共用
+    tracker = DigestTracker(loader.db_session, args.kind)
+    history = History(loader.db_session, args.kind)
+
+    if args.kind == 'detail':
+        crawl = lambda codes: loader.do_em_dt_stream([codes], lambda code: None, args.concurrency, args.rps or 10, set(codes),
+                                                     tracker, history)
+    else:
+        crawl = lambda codes: loader.getRate_stream([codes], args.rps or 5, set(codes), tracker, history)
+
+    work(queue, crawl, args.lease)
+
+    from net import report
+    report()
+
+    loader.db_session.close()
+
+    write_metrics('worker_' + args.kind, monotonic() - s_time)
+
+    logging.info('worker cost {:.2f} seconds!'.format(monotonic() - s_time))
+
+
+if __name__ == "__main__":
+    main()